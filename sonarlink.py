@@ -2,434 +2,3992 @@
 """
 SonarLink v1.0: Send and receive messages and files via ggwave
 - Audio frequency 48000 Hz
-- Gzip compression
+- Adaptive compression (zlib, bz2, lzma; zstd/brotli if installed)
 - Optional AES or RSA encryption
 - Encrypted files saved locally before transmission
 """
 
-import os, sys, time, base64, gzip
+import os, sys, time, base64, gzip, zlib, tempfile, itertools, queue, threading, argparse
+import binascii, hashlib, json, bz2, lzma, mmap, struct, shutil, io, contextlib, functools, socket
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 
 try:
     import pyaudio
 except ImportError:
-    print("Error: install pyaudio (pip3 install pyaudio)")
+    print("PyAudio not available: only the wav/loopback transports work (pip3 install pyaudio)")
+    pyaudio = None
+
+try:
+    import ggwave
+except ImportError:
+    print("Error: install ggwave (pip3 install ggwave-wheels)")
     sys.exit(1)
 
-try:
-    import ggwave
-except ImportError:
-    print("Error: install ggwave (pip3 install ggwave-wheels)")
-    sys.exit(1)
+# Optional compressors, tried alongside zlib/bz2/lzma when installed
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    from cryptography.hazmat.primitives import serialization, hashes, hmac
+    from cryptography.hazmat.primitives.asymmetric import padding
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.backends import default_backend
+except ImportError:
+    print("Cryptography not available: install cryptography")
+    HAS_CRYPTO = False
+else:
+    HAS_CRYPTO = True
+
+SAMPLE_RATE = 48000
+CHUNK_SIZE = 4096
+VOLUME = 80
+PROTOCOL_ID = 1  # GGWAVE_PROTOCOL_AUDIBLE_FAST
+MAX_FILE_SIZE = 1024 * 1024 * 1024  # 1 GB limit; files are streamed, never loaded whole
+GGWAVE_MAX_BYTES = 120  # Maximum bytes per ggwave transmission
+BYTES_PER_FRAME = 4  # float32 per sample (one channel)
+FRAME_HEADER_SIZE = 10  # transfer id (2) + chunk index (3) + chunk total (3) + CRC-16 (2)
+MAX_FRAMES = (1 << 24) - 1  # data + parity frames per transfer: indices and totals are 3 bytes
+PROTOCOL_NAMES = {
+    0: "AUDIBLE_NORMAL", 1: "AUDIBLE_FAST", 2: "AUDIBLE_FASTEST",
+    3: "ULTRASOUND_NORMAL", 4: "ULTRASOUND_FAST", 5: "ULTRASOUND_FASTEST",
+    6: "DT_NORMAL", 7: "DT_FAST", 8: "DT_FASTEST",
+    9: "MT_NORMAL", 10: "MT_FAST", 11: "MT_FASTEST",
+}
+# Named transmission profiles; "pacing" entries override PACING,
+# "fec" is (data chunks, parity chunks) per Reed-Solomon group or None,
+# "lanes" stripes chunks over simultaneous (channel, protocol) streams
+PROFILES = {
+    "default": {"protocol": PROTOCOL_ID, "volume": VOLUME, "payload": GGWAVE_MAX_BYTES, "pacing": {}, "fec": None},
+    "normal": {"protocol": 0, "volume": VOLUME, "payload": GGWAVE_MAX_BYTES, "pacing": {}, "fec": None},
+    "fastest": {"protocol": 2, "volume": VOLUME, "payload": GGWAVE_MAX_BYTES, "pacing": {}, "fec": None},
+    "ultrasonic": {"protocol": 4, "volume": VOLUME, "payload": GGWAVE_MAX_BYTES, "pacing": {}, "fec": None},
+    "ultrasonic-fastest": {"protocol": 5, "volume": VOLUME, "payload": GGWAVE_MAX_BYTES, "pacing": {}, "fec": None},
+    "dual-tone": {"protocol": 8, "volume": VOLUME, "payload": GGWAVE_MAX_BYTES, "pacing": {}, "fec": None},
+    # Reed-Solomon: 3 parity chunks per 8 data chunks survive any 3 losses per group
+    "robust": {"protocol": PROTOCOL_ID, "volume": VOLUME, "payload": GGWAVE_MAX_BYTES, "pacing": {}, "fec": (8, 3)},
+    # Striped: audible and ultrasonic bands mixed into one speaker, or one stream per stereo channel
+    "dual-band": {"protocol": 2, "volume": VOLUME, "payload": GGWAVE_MAX_BYTES, "pacing": {}, "fec": None,
+                  "lanes": [(0, 2), (0, 5)]},
+    "stereo": {"protocol": PROTOCOL_ID, "volume": VOLUME, "payload": GGWAVE_MAX_BYTES, "pacing": {}, "fec": None,
+               "lanes": [(0, PROTOCOL_ID), (1, PROTOCOL_ID)]},
+    "stereo-dual-band": {"protocol": 2, "volume": VOLUME, "payload": GGWAVE_MAX_BYTES, "pacing": {}, "fec": None,
+                         "lanes": [(0, 2), (0, 5), (1, 2), (1, 5)]},
+}
+ACTIVE_PROFILE = "default"
+BENCHMARK_TRIALS = 3
+BENCHMARK_SNR = -5  # White noise (SNR dB) mixed into each protocol benchmark trial; low enough that weaker protocols drop frames
+# Silence after each frame per ggwave protocol id: slower protocols use longer
+# symbols, so the room echo a receiver must ride out is longer too
+PROTOCOL_GUARD = {0: 0.30, 1: 0.20, 2: 0.12, 3: 0.30, 4: 0.20, 5: 0.12,
+                  6: 0.40, 7: 0.30, 8: 0.20, 9: 0.40, 10: 0.30, 11: 0.20}
+PACING = {
+    "ratio": 0.03,   # extra gap per second of frame, absorbs clock drift
+    "settle": 0.5,   # extra gap after FILE/ENDFILE so the receiver can set up
+    "gap": None,     # fixed per-frame gap from calibration, overrides the model
+}
+CALIBRATION_GAPS = (1.0, 0.6, 0.4, 0.25, 0.15, 0.1, 0.05, 0.0)
+CALIBRATION_REPEATS = 5
+DUPLEX_WINDOW = 8  # Initial chunks per ACK window in half-duplex mode
+DUPLEX_WINDOW_RANGE = (2, 32)  # Window shrinks/grows within these bounds
+DUPLEX_PACING_RANGE = (0.25, 2.0)  # Scale applied to the pacing model as loss changes
+DUPLEX_MAX_SPAN = 256  # Max index span one ACK bitmap can describe
+DUPLEX_RETRIES = 3  # WIN requests without an ACK before giving up
+CAPTURE_RING_BLOCKS = 64  # Captured blocks buffered for the decoder (~5.5 s)
+COMPRESS_SAMPLE = 256 * 1024  # Bytes tried with every codec before choosing one
+COMPRESS_MIN_GAIN = 0.97  # Send uncompressed unless the best codec beats this ratio
+COMPRESSED_MAGIC = b"SLZ1"  # Tags compressed plaintext inside encrypted files
+ARCHIVE_MAGIC = b"SLB1"  # Batch archives: JSON manifest, then every file's bytes, compressed as one stream
+DELTA_MAGIC = b"SLD1"  # Delta transfers: copy/literal ops against the receiver's stored copy
+DELTA_CHUNK_RANGE = (2048, 65536)  # Min/max content-defined chunk size in bytes
+DELTA_CHUNK_MASK = 0xFFF80000  # 13 high gear-hash bits must be zero: ~8 KB average chunks
+DELTA_STATE = os.path.join(os.path.expanduser("~"), ".sonarlink", "delta")  # Sender's manifests per receiver
+RSA_ENVELOPE_MAGIC = b"SLR1"  # Hybrid RSA files: wrapped data key + AES-GCM segments
+AEAD_SEGMENT = 64 * 1024  # Plaintext bytes per authenticated segment
+AEAD_TAG_SIZE = 16
+AEAD_PREFIX_SIZE = 7  # Random nonce prefix; the rest is a segment counter and a last-segment flag
+AES_SEGMENTED_MAGIC = b"SLA1"  # Password files: PBKDF2 key + chunk-aligned AES-GCM segments
+AES_SEGMENT_CHUNKS = 32  # Transmission chunks per AES-GCM segment in password files
+AES_KDF_ITERATIONS = 600000  # PBKDF2-SHA256 rounds for new password files
+DECRYPT_WORKERS = os.cpu_count() or 2  # Threads verifying/decrypting segments
+SPOOL_BLOCK = 1024 * 1024  # Bytes read per step while compressing/encrypting a file for sending
+RENDER_WORKERS = 2  # Threads encoding waveforms ahead of playback
+RENDER_LOOKAHEAD = 4  # Max waveforms rendered but not yet played
+RENDER_MEMORY_CAP = 64 * 1024 * 1024  # Max bytes held by rendered-ahead waveforms
+WAVEFORM_CACHE_BYTES = 64 * 1024 * 1024  # Rendered waveforms kept in memory (LRU)
+WAVEFORM_CACHE_DIR = None  # Directory for an on-disk waveform cache too, e.g. ~/.sonarlink/waveforms
+WAVEFORM_CACHE_DISK_BYTES = 1024 * 1024 * 1024  # Size cap of the on-disk cache
+CAROUSEL_HEADER_EVERY = 16  # Data frames between repeats of the FILE header in a carousel cycle
+TRANSPORT = {"kind": "audio", "path": "sonarlink.wav"}  # audio (PyAudio), wav or loopback
+REPLAY_TRAILING = 1.0  # Seconds of silence appended to replayed audio so the last frame decodes
+BENCHMARK_SIZES = (256, 2048, 8192)  # File sizes for the end-to-end benchmark
+BENCHMARK_NOISE = (None, 10, 0, -5)  # Injected white noise as SNR in dB (None = clean)
+DEVICE_RATE = None  # Microphone rate in Hz; None tries SAMPLE_RATE, then the device's default
+DECODER_FRAME = 1024  # ggwave only decodes whole frames of this many samples
+# Receive front end stages, applied to every lane before ggwave
+FRONT_END = {
+    "dc": True,        # remove the DC offset
+    "bandpass": True,  # keep only the band of the protocol(s) listened for
+    "agc": True,       # steer the level toward AGC_TARGET
+    "meter": True,     # show level and SNR while a live receiver is idle
+}
+# Occupied spectrum per ggwave protocol id in Hz (99.8% of the energy)
+PROTOCOL_BANDS = {0: (1850, 6250), 1: (1850, 6250), 2: (1850, 6250),
+                  3: (14950, 19400), 4: (14950, 19400), 5: (14950, 19400),
+                  6: (1100, 2600), 7: (1100, 2600), 8: (1100, 2600)}
+BANDPASS_MARGIN = 400  # Hz kept on each side of a protocol band
+BANDPASS_TAPS = 255  # FIR length; about 700 Hz transition band at 48 kHz
+RESAMPLE_TAPS = 32  # FIR taps per polyphase branch
+AGC_TARGET = 0.1  # RMS level the AGC steers toward (-20 dBFS)
+AGC_MAX_GAIN = 1000.0  # +60 dB ceiling so silence is not blown up
+AGC_ATTACK = 0.5  # Fraction of the gap (in dB) closed per block when the gain falls
+AGC_RELEASE = 0.05  # ...and when it rises
+DC_SMOOTHING = 0.05  # Weight of each block mean in the DC estimate
+SNR_FLOOR_BLOCKS = 32  # Blocks (~2.7 s) the in-band noise floor is the minimum of
+CLIP_LEVEL = 0.999  # Peak at or above which a block counts as clipped
+METER_INTERVAL = 0.5  # Seconds between live level/SNR updates
+# Telemetry sinks: a JSON lines file and a Prometheus textfile (node_exporter
+# textfile collector), None for off; "station" labels every record
+TELEMETRY = {"jsonl": None, "prometheus": None, "station": socket.gethostname()}
+
+# ------------------
+# Transmission profiles
+# ------------------
+def get_profile(name=None):
+    return PROFILES[name or ACTIVE_PROFILE]
+
+def set_profile(name):
+    global ACTIVE_PROFILE
+    if name not in PROFILES:
+        raise ValueError(f"Unknown profile: {name}")
+    ACTIVE_PROFILE = name
+
+def profile_channels(profile=None):
+    """Audio channels a profile needs: one unless its lanes use a second speaker/microphone."""
+    profile = profile or get_profile()
+    return max(channel for channel, _ in profile.get("lanes") or [(0, None)]) + 1
+
+def capture_lanes(profile=None):
+    """(channel, protocol) per receive decoder; None listens for every protocol."""
+    profile = profile or get_profile()
+    return profile.get("lanes") or [(0, None)]
+
+# ------------------
+# Telemetry
+# ------------------
+# Timings and counters from the send and receive paths. Each event becomes
+# one JSON object per line in TELEMETRY["jsonl"]; counters and timing
+# summaries are rewritten to TELEMETRY["prometheus"] (a node_exporter
+# textfile) on flush(). Aggregation is in-memory and cheap, so it runs even
+# with no sink configured.
+METRIC_HELP = {
+    "encode_seconds": ("summary", "Time rendering one waveform with ggwave.encode"),
+    "play_seconds": ("summary", "Time writing one frame (or striped mix) to the output"),
+    "gap_seconds": ("summary", "Silence written after a frame"),
+    "decode_latency_seconds": ("summary", "Capture of a block to the end of its decoding"),
+    "hot_path_seconds": ("summary", "Calls of profiled hot paths (--profile)"),
+    "waveform_cache_hits_total": ("counter", "Waveforms served from the cache"),
+    "frames_sent_total": ("counter", "Frames played"),
+    "frames_received_total": ("counter", "Payloads decoded"),
+    "crc_failures_total": ("counter", "Chunks dropped for a bad frame or CRC"),
+    "chunks_missing_total": ("counter", "Chunks still missing when a transfer ended"),
+    "input_overflows_total": ("counter", "Input device overflows"),
+    "dropped_frames_total": ("counter", "Captured audio frames dropped on a full ring"),
+    "transfers_total": ("counter", "Transfers finished, by direction and result"),
+    "goodput_bytes_per_second": ("gauge", "Stream bytes per second of audio in the last transfer"),
+}
+
+class Telemetry:
+    """Thread-safe counters, timing summaries and a JSON lines event log."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}  # (name, labels) -> value
+        self.timings = {}  # (name, labels) -> [count, sum, max]
+        self.gauges = {}
+        self.log = None
+
+    def event(self, kind, **fields):
+        if not TELEMETRY["jsonl"]:
+            return
+        record = {"ts": round(time.time(), 6), "station": TELEMETRY["station"], "event": kind, **fields}
+        line = json.dumps(record, separators=(",", ":"), default=str) + "\n"
+        with self.lock:
+            if self.log is None:
+                self.log = open(TELEMETRY["jsonl"], "a", buffering=1)
+            self.log.write(line)
+
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            stats = self.timings.setdefault(key, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+
+    def gauge(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def prometheus_text(self):
+        station = ("station", TELEMETRY["station"])
+        samples = {}
+        with self.lock:
+            for (name, labels), value in self.counters.items():
+                samples.setdefault(name, []).append(("", labels, value))
+            for (name, labels), value in self.gauges.items():
+                samples.setdefault(name, []).append(("", labels, value))
+            for (name, labels), (count, total, _) in self.timings.items():
+                samples.setdefault(name, []).extend([("_sum", labels, total), ("_count", labels, count)])
+        lines = []
+        for name in sorted(samples):
+            kind, text = METRIC_HELP.get(name, ("untyped", name))
+            lines += [f"# HELP sonarlink_{name} {text}", f"# TYPE sonarlink_{name} {kind}"]
+            for suffix, labels, value in samples[name]:
+                label_text = ",".join(f'{key}="{val}"' for key, val in (station,) + labels)
+                lines.append(f"sonarlink_{name}{suffix}{{{label_text}}} {value:g}")
+        return "\n".join(lines) + "\n"
+
+    def flush(self):
+        """Rewrite the Prometheus textfile (atomically, as the textfile collector expects)."""
+        path = TELEMETRY["prometheus"]
+        if path:
+            with open(path + ".tmp", "w") as f:
+                f.write(self.prometheus_text())
+            os.replace(path + ".tmp", path)
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            if self.log is not None:
+                self.log.close()
+                self.log = None
+
+METRICS = Telemetry()
+
+def profiled(name, fn):
+    """Wrap fn so every call is timed into the hot_path_seconds summary."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            METRICS.observe("hot_path_seconds", time.perf_counter() - started, path=name)
+    return wrapper
+
+def enable_profiling():
+    """Time the hot paths: waveform rendering, playback, decoding and chunk reassembly."""
+    module = sys.modules[__name__]
+    for name in ("prepare_waveform", "render_waveform", "tx_message"):
+        setattr(module, name, profiled(name, getattr(module, name)))
+    ggwave.decode = profiled("ggwave.decode", ggwave.decode)
+    PartialTransfer.add = profiled("reassembly", PartialTransfer.add)
+    StreamingFileWriter.feed = profiled("decompress", StreamingFileWriter.feed)
+
+def profile_report():
+    rows = sorted(((dict(labels)["path"], stats) for (name, labels), stats in METRICS.timings.items()
+                   if name == "hot_path_seconds"), key=lambda row: -row[1][1])
+    if not rows:
+        return
+    print("⏱️ Hot paths:")
+    print(f"   {'path':<18} {'calls':>7} {'total s':>9} {'mean ms':>9} {'max ms':>9}")
+    for path, (count, total, peak) in rows:
+        print(f"   {path:<18} {count:>7} {total:9.3f} {total / count * 1000:9.2f} {peak * 1000:9.2f}")
+        METRICS.event("hot_path", path=path, calls=count, total_s=round(total, 6), max_s=round(peak, 6))
+
+# ------------------
+# Waveform preparation
+# ------------------
+class WaveformCache:
+    """LRU cache of rendered waveforms keyed by payload, protocol and volume.
+
+    Up to `memory_bytes` stay in memory. With a disk directory set, every
+    waveform is also kept there as raw float32, up to `disk_bytes`, the
+    least recently used files going first. ggwave.encode is deterministic,
+    so a cached waveform is exactly what a fresh render would give.
+    """
+
+    def __init__(self, memory_bytes, disk_dir=None, disk_bytes=0):
+        self.memory_bytes = memory_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.disk_dir = None
+        self.disk_bytes = disk_bytes
+        self.disk_size = 0
+        if disk_dir:
+            self.use_disk(disk_dir, disk_bytes)
+
+    def use_disk(self, directory, disk_bytes=None):
+        os.makedirs(directory, exist_ok=True)
+        self.disk_dir = directory
+        self.disk_bytes = disk_bytes or self.disk_bytes or WAVEFORM_CACHE_DISK_BYTES
+        self.disk_size = sum(entry.stat().st_size for entry in os.scandir(directory) if entry.name.endswith(".f32"))
+
+    @staticmethod
+    def key(message, profile):
+        payload = message.encode("utf-8") if isinstance(message, str) else bytes(message)
+        return hashlib.sha256(f"{profile['protocol']}:{profile['volume']}:".encode() + payload).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            waveform = self.entries.get(key)
+            if waveform is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return waveform
+        if self.disk_dir is not None:
+            path = os.path.join(self.disk_dir, key + ".f32")
+            try:
+                with open(path, "rb") as f:
+                    waveform = f.read()
+                os.utime(path)  # mtime is the disk LRU order
+            except OSError:
+                pass
+            else:
+                with self.lock:
+                    self.disk_hits += 1
+                self._remember(key, waveform)
+                return waveform
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, waveform):
+        self._remember(key, waveform)
+        if self.disk_dir is not None:
+            path = os.path.join(self.disk_dir, key + ".f32")
+            if not os.path.exists(path) and self._write_disk(path, waveform):
+                with self.lock:
+                    self.disk_size += len(waveform)
+                    over = self.disk_size > self.disk_bytes
+                if over:
+                    self._trim_disk()
+
+    def _write_disk(self, path, waveform):
+        """Store a waveform file; True only if this call created it.
+
+        Render-ahead workers and other processes sharing the directory may
+        store the same key at once, so each writes its own temporary file
+        and links it into place; the first link wins.
+        """
+        fd, temp_path = tempfile.mkstemp(dir=self.disk_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(waveform)
+            try:
+                os.link(temp_path, path)
+                return True
+            except FileExistsError:
+                return False
+            except OSError:  # no hard links on this filesystem
+                created = not os.path.exists(path)
+                os.replace(temp_path, path)
+                return created
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(temp_path)
+
+    def _remember(self, key, waveform):
+        if len(waveform) > self.memory_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = waveform
+            self.size += len(waveform)
+            while self.size > self.memory_bytes:
+                _, old = self.entries.popitem(last=False)
+                self.size -= len(old)
+
+    def _trim_disk(self):
+        """Delete the least recently used files until the disk cache is 10% under its cap."""
+        files = sorted((entry.stat().st_mtime, entry.stat().st_size, entry.path)
+                       for entry in os.scandir(self.disk_dir) if entry.name.endswith(".f32"))
+        size = sum(item[1] for item in files)
+        for _, length, path in files:
+            if size <= self.disk_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= length
+        with self.lock:
+            self.disk_size = size
+
+    def summary(self):
+        disk = f", {self.disk_hits} from disk" if self.disk_dir else ""
+        return (f"{self.hits + self.disk_hits} hits{disk}, {self.misses} renders, "
+                f"{len(self.entries)} waveforms / {self.size / 1e6:.1f} MB in memory")
+
+WAVEFORMS = WaveformCache(WAVEFORM_CACHE_BYTES, WAVEFORM_CACHE_DIR, WAVEFORM_CACHE_DISK_BYTES)
+
+def prepare_waveform(message: str, profile=None):
+    profile = profile or get_profile()
+    if not isinstance(message, str) and not ggwave_accepts_bytes():
+        message = message.decode('utf-8', errors='ignore')
+    key = WAVEFORMS.key(message, profile)
+    waveform = WAVEFORMS.get(key)
+    if waveform is not None:
+        METRICS.count("waveform_cache_hits_total")
+        METRICS.event("encode", protocol=profile["protocol"], payload=len(message), cached=True, seconds=0.0)
+        return waveform
+    started = time.perf_counter()
+    waveform = render_waveform(message, profile)
+    elapsed = time.perf_counter() - started
+    WAVEFORMS.put(key, waveform)
+    METRICS.observe("encode_seconds", elapsed)
+    METRICS.event("encode", protocol=profile["protocol"], payload=len(message), cached=False,
+                  seconds=round(elapsed, 6))
+    return waveform
+
+def render_waveform(message, profile):
+    raw = ggwave.encode(message, protocolId=profile["protocol"], volume=profile["volume"])
+    if isinstance(raw, (bytes, bytearray)):
+        return bytes(raw)
+    arr = np.asarray(raw, dtype=np.float32).flatten()
+    return arr.tobytes()
+
+def render_ahead(messages, profile=None, lookahead=None, memory_cap=None, workers=None, profiles=None):
+    """Yield prepare_waveform() for each message while later ones render in a pool.
+
+    At most `lookahead` waveforms are queued and their estimated size is kept
+    under `memory_cap`, so a long transfer never holds more than a few frames.
+    `profiles`, if given, yields the profile of each message in turn.
+    """
+    lookahead = lookahead or RENDER_LOOKAHEAD
+    memory_cap = memory_cap or RENDER_MEMORY_CAP
+    source = iter(messages)
+    profiles = iter(profiles) if profiles is not None else itertools.repeat(profile)
+    pending = deque()
+    largest = 0
+    exhausted = False
+    pool = ThreadPoolExecutor(max_workers=workers or RENDER_WORKERS)
+
+    def fill():
+        nonlocal exhausted
+        while not exhausted and len(pending) < lookahead:
+            if pending and largest * (len(pending) + 1) > memory_cap:
+                break
+            msg = next(source, None)
+            if msg is None:
+                exhausted = True
+                break
+            pending.append(pool.submit(prepare_waveform, msg, next(profiles)))
+
+    try:
+        fill()
+        while pending:
+            waveform = pending.popleft().result()
+            largest = max(largest, len(waveform))
+            fill()  # queue the next renders before handing this one to the audio thread
+            yield waveform
+    finally:
+        for future in pending:
+            future.cancel()
+        pool.shutdown(wait=False)
+
+# ------------------
+# Pacing
+# ------------------
+def waveform_duration(waveform):
+    return len(waveform) / (BYTES_PER_FRAME * SAMPLE_RATE)
+
+class Pacer:
+    """Silence to leave after each frame, derived from its rendered length."""
+
+    def __init__(self, profile=None):
+        profile = profile or get_profile()
+        pacing = {**PACING, **profile.get("pacing", {})}
+        self.guard = PROTOCOL_GUARD.get(profile["protocol"], 0.3)
+        self.ratio = pacing["ratio"]
+        self.settle = pacing["settle"]
+        self.fixed = pacing["gap"]
+        self.scale = 1.0  # tightened or relaxed by half-duplex flow control
+        self.total = 0.0
+
+    def gap(self, waveform, control=False):
+        if self.fixed is not None:
+            seconds = self.fixed
+        else:
+            seconds = self.guard + self.ratio * waveform_duration(waveform)
+        seconds *= self.scale
+        if control:
+            seconds += self.settle
+        self.total += seconds
+        return seconds
+
+# ------------------
+# Audio transports
+# ------------------
+# TxSession writes and AudioCapture reads through one of these, picked by
+# TRANSPORT: live PyAudio devices, a float32 WAV file, or an in-memory
+# loopback buffer. The offline ones run as fast as the CPU allows.
+LOOPBACK = bytearray()  # loopback transport: samples sent and not yet received
+
+def set_transport(kind, path=None):
+    if kind not in ("audio", "wav", "loopback"):
+        raise ValueError(f"Unknown transport: {kind}")
+    TRANSPORT["kind"] = kind
+    if path:
+        TRANSPORT["path"] = path
+
+def require_pyaudio():
+    if pyaudio is None:
+        raise RuntimeError("PyAudio not installed: pip3 install pyaudio, or pick the wav/loopback transport")
+
+class PyAudioOutput:
+    """Speaker output through PortAudio."""
+
+    realtime = True
+
+    def __init__(self, channels=1):
+        self.channels = channels
+        self.p = None
+        self.stream = None
+
+    def open(self):
+        require_pyaudio()
+        self.p = pyaudio.PyAudio()
+        try:
+            self.stream = self.p.open(format=pyaudio.paFloat32, channels=self.channels,
+                                      rate=SAMPLE_RATE, output=True,
+                                      frames_per_buffer=CHUNK_SIZE)
+        except Exception:
+            self.p.terminate()
+            self.p = None
+            raise
+
+    def write(self, block):
+        self.stream.write(block)
+
+    def close(self):
+        if self.stream is not None:
+            try:
+                self.stream.stop_stream()  # drains queued audio
+                self.stream.close()
+            finally:
+                self.stream = None
+        if self.p is not None:
+            self.p.terminate()
+            self.p = None
+
+def wav_header(data_bytes, channels=1):
+    # 32-bit float; sizes are patched in when the file is closed
+    return struct.pack("<4sI4s4sIHHIIHH4sI", b"RIFF", 36 + data_bytes, b"WAVE",
+                       b"fmt ", 16, 3, channels, SAMPLE_RATE, SAMPLE_RATE * BYTES_PER_FRAME * channels,
+                       BYTES_PER_FRAME * channels, 32, b"data", data_bytes)
+
+class WavOutput:
+    """Writes the exact sample stream a speaker would play to a float32 WAV file."""
+
+    realtime = False
+
+    def __init__(self, path, channels=1):
+        self.path = path
+        self.channels = channels
+        self.f = None
+        self.size = 0
+
+    def open(self):
+        self.f = open(self.path, "wb")
+        self.f.write(wav_header(0, self.channels))
+        self.size = 0
+
+    def write(self, block):
+        self.f.write(block)
+        self.size += len(block)
+
+    def close(self):
+        if self.f is not None:
+            self.f.seek(0)
+            self.f.write(wav_header(self.size, self.channels))
+            self.f.close()
+            self.f = None
+
+class LoopbackOutput:
+    """Appends the (interleaved) sample stream to LOOPBACK for a receiver in the same process."""
+
+    realtime = False
+
+    def open(self):
+        pass
+
+    def write(self, block):
+        LOOPBACK.extend(block)
+
+    def close(self):
+        pass
+
+class SpoolOutput:
+    """Appends the sample stream to an open file, for playing back later."""
+
+    realtime = False
+
+    def __init__(self, f):
+        self.f = f
+
+    def open(self):
+        pass
+
+    def write(self, block):
+        self.f.write(block)
+
+    def close(self):
+        self.f.flush()
+
+def make_output(channels=1):
+    if TRANSPORT["kind"] == "wav":
+        return WavOutput(TRANSPORT["path"], channels)
+    if TRANSPORT["kind"] == "loopback":
+        return LoopbackOutput()
+    return PyAudioOutput(channels)
+
+def wav_blocks(path, channels=1):
+    """Return (sample rate, iterator of CHUNK_SIZE-frame float32 blocks) for a WAV file.
+
+    Float32 and 16-bit PCM are read; blocks hold the first `channels`
+    channels, interleaved. Other rates are left to the receive front end
+    to resample.
+
+    The header is checked right away so a bad file fails before playback starts.
+    """
+    f = open(path, "rb")
+    try:
+        riff, _, wave_id = struct.unpack("<4sI4s", f.read(12))
+        if riff != b"RIFF" or wave_id != b"WAVE":
+            raise ValueError(f"Not a WAV file: {path}")
+        fmt = None
+        while True:
+            head = f.read(8)
+            if len(head) < 8:
+                raise ValueError(f"No audio data in {path}")
+            chunk_id, size = struct.unpack("<4sI", head)
+            if chunk_id == b"data" and fmt is not None:
+                break
+            body = f.read(size + (size & 1))
+            if chunk_id == b"fmt ":
+                fmt = body
+        tag, file_channels, rate, _, _, bits = struct.unpack("<HHIIHH", fmt[:16])
+        if tag == 0xFFFE:  # WAVE_FORMAT_EXTENSIBLE: the real tag opens the subformat GUID
+            tag = struct.unpack("<H", fmt[24:26])[0]
+        if channels > file_channels:
+            raise ValueError(f"{path} has {file_channels} channel(s), the profile needs {channels}")
+        if (tag, bits) == (3, 32):
+            dtype, scale = np.float32, 1.0
+        elif (tag, bits) == (1, 16):
+            dtype, scale = np.int16, 1 / 32768
+        else:
+            raise ValueError(f"Unsupported WAV encoding in {path} (format {tag}, {bits}-bit)")
+    except Exception:
+        f.close()
+        raise
+
+    def blocks():
+        frame_bytes = file_channels * bits // 8
+        remaining = size or float("inf")  # 0 when the writer never finalized the header
+        with f:
+            while remaining > 0:
+                raw = f.read(int(min(CHUNK_SIZE * frame_bytes, remaining)))
+                raw = raw[:len(raw) - len(raw) % frame_bytes]
+                if not raw:
+                    return
+                remaining -= len(raw)
+                samples = np.frombuffer(raw, dtype=dtype).reshape(-1, file_channels)[:, :channels]
+                yield (samples.astype(np.float32) * scale).tobytes()
+    return rate, blocks()
+
+def loopback_blocks(channels=1):
+    """Drain LOOPBACK in CHUNK_SIZE-frame blocks."""
+    data = bytes(LOOPBACK)
+    LOOPBACK.clear()
+    chunk_bytes = CHUNK_SIZE * BYTES_PER_FRAME * channels
+    for i in range(0, len(data), chunk_bytes):
+        yield data[i:i+chunk_bytes]
+
+class PyAudioInput:
+    """Microphone capture in PortAudio callback mode, feeding AudioCapture's ring.
+
+    Devices that refuse SAMPLE_RATE are opened at their default rate; the
+    receive front end resamples.
+    """
+
+    realtime = True
+
+    def __init__(self, channels=1):
+        self.channels = channels
+        self.rate = DEVICE_RATE or SAMPLE_RATE
+        self.p = None
+        self.stream = None
+
+    def start(self, capture):
+        require_pyaudio()
+        self.p = pyaudio.PyAudio()
+        try:
+            try:
+                self._open(capture, DEVICE_RATE or SAMPLE_RATE)
+            except Exception:
+                if DEVICE_RATE:
+                    raise
+                self._open(capture, int(self.p.get_default_input_device_info()["defaultSampleRate"]))
+        except Exception:
+            self.p.terminate()
+            self.p = None
+            raise
+
+    def _open(self, capture, rate):
+        self.stream = self.p.open(format=pyaudio.paFloat32, channels=self.channels,
+                                  rate=rate, input=True,
+                                  frames_per_buffer=CHUNK_SIZE * rate // SAMPLE_RATE,
+                                  stream_callback=capture._on_audio)
+        self.rate = rate
+
+    def is_active(self):
+        return self.stream is not None and self.stream.is_active()
+
+    def stop(self):
+        if self.stream is not None:
+            self.stream.stop_stream()
+            self.stream.close()
+            self.stream = None
+        if self.p is not None:
+            self.p.terminate()
+            self.p = None
+
+class ReplayInput:
+    """Feeds recorded blocks to AudioCapture's ring as fast as the decoder drains it.
+
+    Nothing is dropped: the feeder blocks on a full ring instead, so a
+    recording decodes faster than real time with the same code path as a
+    live microphone.
+    """
+
+    realtime = False
+
+    def __init__(self, blocks, rate=SAMPLE_RATE):
+        self.blocks = blocks
+        self.rate = rate
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    def start(self, capture):
+        trailing = b"\0" * (int(REPLAY_TRAILING * self.rate) * BYTES_PER_FRAME * capture.channels)
+        chunk_bytes = CHUNK_SIZE * BYTES_PER_FRAME * capture.channels
+        silence = (trailing[i:i+chunk_bytes] for i in range(0, len(trailing), chunk_bytes))
+        self.thread = threading.Thread(target=self._feed, args=(capture, itertools.chain(self.blocks, silence)),
+                                       name="sonarlink-replay", daemon=True)
+        self.thread.start()
+
+    def _feed(self, capture, blocks):
+        for block in blocks:
+            while not self.stop_event.is_set():
+                try:
+                    capture.ring.put((time.perf_counter(), block), timeout=0.25)
+                    break
+                except queue.Full:
+                    continue
+            if self.stop_event.is_set():
+                return
+
+    def is_active(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+def make_input(channels=1):
+    if TRANSPORT["kind"] == "wav":
+        rate, blocks = wav_blocks(TRANSPORT["path"], channels)
+        return ReplayInput(blocks, rate)
+    if TRANSPORT["kind"] == "loopback":
+        return ReplayInput(loopback_blocks(channels))
+    return PyAudioInput(channels)
+
+# ------------------
+# Audio transmission
+# ------------------
+LEGACY_WRITE_SLEEP = 0.05  # pause the old per-chunk stream added after each buffer write
+
+class TxSession:
+    """Long-lived output stream shared by every frame of a transfer or text batch.
+
+    `output` overrides the active TRANSPORT (the carousel records into a spool file).
+    """
+
+    def __init__(self, output=None):
+        self.target = output
+        self.output = None
+        self.realtime = True
+        self.channels = 1
+        self.messages = 0
+        self.writes = 0
+        self.frames_written = 0
+        self.setup_time = 0.0
+        self.last_frame = None  # telemetry for the frame written last, sent once its gap is known
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def open(self):
+        started = time.perf_counter()
+        self.channels = profile_channels()
+        output = self.target or make_output(self.channels)
+        output.open()
+        self.output = output
+        self.realtime = output.realtime
+        self.setup_time = time.perf_counter() - started
+
+    def send(self, waveform):
+        if self.channels > 1:
+            # Mono frames (text, control, replies) play on the first channel only
+            mono = np.frombuffer(waveform, dtype=np.float32)
+            frames = np.zeros((mono.size, self.channels), dtype=np.float32)
+            frames[:, 0] = mono
+            waveform = frames.tobytes()
+        self.write(waveform, messages=1)
+
+    def write(self, samples, messages=0):
+        """Write interleaved float32 samples; `messages` counts frames mixed into them."""
+        self._frame_done(0.0)
+        started = time.perf_counter()
+        # Blocking writes back to back: PortAudio paces us, no sleeps needed
+        frame_bytes = BYTES_PER_FRAME * self.channels
+        chunk_bytes = CHUNK_SIZE * frame_bytes
+        for i in range(0, len(samples), chunk_bytes):
+            block = samples[i:i+chunk_bytes]
+            self.output.write(block)
+            self.writes += 1
+            self.frames_written += len(block) // frame_bytes
+        self.messages += messages
+        if messages:
+            elapsed = time.perf_counter() - started
+            METRICS.observe("play_seconds", elapsed)
+            METRICS.count("frames_sent_total", messages)
+            self.last_frame = {"frames": messages, "airtime_s": round(len(samples) / frame_bytes / SAMPLE_RATE, 6),
+                               "play_s": round(elapsed, 6)}
+
+    def _frame_done(self, gap):
+        if self.last_frame is not None:
+            METRICS.observe("gap_seconds", gap)
+            METRICS.event("frame_tx", gap_s=round(gap, 6), **self.last_frame)
+            self.last_frame = None
+
+    def pause(self, seconds):
+        self._frame_done(seconds)
+        # Keep the stream fed with silence instead of letting it underrun
+        frames = int(seconds * SAMPLE_RATE)
+        while frames > 0:
+            n = min(frames, CHUNK_SIZE)
+            self.output.write(b"\0" * (n * BYTES_PER_FRAME * self.channels))
+            self.frames_written += n
+            frames -= n
+
+    def dead_time_removed(self):
+        """Seconds of device setup and write sleeps avoided vs. one stream per message."""
+        setup = max(self.messages - 1, 0) * self.setup_time
+        sleeps = self.writes * LEGACY_WRITE_SLEEP
+        return setup, sleeps
+
+    def close(self):
+        self._frame_done(0.0)
+        if self.output is not None:
+            try:
+                self.output.close()
+            finally:
+                self.output = None
+
+    def report(self):
+        if not self.messages or not self.realtime:
+            return
+        setup, sleeps = self.dead_time_removed()
+        per_chunk = (setup + sleeps) / self.messages * 1000
+        print(f"   ⏱️ Dead time removed: {setup:.2f} s device setup + up to {sleeps:.2f} s write sleeps "
+              f"(≤{per_chunk:.0f} ms per chunk, {self.messages} chunks)")
+
+class StripeMixer:
+    """Mixes waveforms from several lanes onto one timeline and streams it out.
+
+    Every lane has its own cursor. Audio before the earliest cursor can no
+    longer change, so it is written to the session as soon as it is final;
+    only about one frame of audio is ever buffered.
+    """
+
+    def __init__(self, session, lanes):
+        self.session = session
+        self.channels = [channel for channel, _ in lanes]
+        # Lanes sharing a channel split its headroom so the mix never clips
+        self.gains = [1 / self.channels.count(channel) for channel in self.channels]
+        self.cursors = [0] * len(lanes)
+        self.base = 0  # timeline position of buf[0]
+        self.buf = np.zeros((0, session.channels), dtype=np.float32)
+        self.placed = 0
+
+    def place(self, lane, waveform, gap):
+        samples = np.frombuffer(waveform, dtype=np.float32)
+        start = self.cursors[lane] - self.base
+        self._reserve(start + samples.size)
+        self.buf[start:start + samples.size, self.channels[lane]] += samples * self.gains[lane]
+        self.cursors[lane] += samples.size + int(gap * SAMPLE_RATE)
+        self.placed += 1
+        self._flush(min(self.cursors))
+
+    def sync(self, extra=0.0):
+        """Line every lane up after the longest one (plus `extra` seconds)."""
+        end = max(self.cursors) + int(extra * SAMPLE_RATE)
+        self.cursors = [end] * len(self.cursors)
+
+    def finish(self):
+        self.sync()
+        self._flush(self.cursors[0])
+
+    def _reserve(self, rows):
+        if rows > len(self.buf):
+            grow = np.zeros((rows - len(self.buf), self.buf.shape[1]), dtype=np.float32)
+            self.buf = np.concatenate([self.buf, grow])
+
+    def _flush(self, upto):
+        rows = upto - self.base
+        if rows <= 0:
+            return
+        self._reserve(rows)
+        self.session.write(self.buf[:rows].tobytes(), self.placed)
+        self.placed = 0
+        self.buf = self.buf[rows:]
+        self.base = upto
+
+def tx_message(waveform, session=None):
+    if session is not None:
+        session.send(waveform)
+        return
+    with TxSession() as single:
+        single.send(waveform)
+
+# ------------------
+# Compression
+# ------------------
+def _zstd_compress(data, level):
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+COMPRESSORS = {
+    # name: compress(data, level); decompression goes through Decompressor
+    "none": lambda data, level: data,
+    "gzip": lambda data, level: gzip.compress(data, compresslevel=level, mtime=0),
+    "zlib": lambda data, level: zlib.compress(data, level),
+    "bz2": lambda data, level: bz2.compress(data, level),
+    "lzma": lambda data, level: lzma.compress(data, format=lzma.FORMAT_ALONE, preset=level),
+    "zstd": _zstd_compress,
+    "brotli": lambda data, level: brotli.compress(data, quality=level),
+}
+# Tried in order on a sample; ties keep the earlier (cheaper) candidate
+COMPRESSION_CANDIDATES = [("zlib", 1), ("zlib", 6), ("zlib", 9), ("bz2", 9),
+                          ("lzma", 6), ("lzma", 9 | lzma.PRESET_EXTREME)]
+if zstandard is not None:
+    COMPRESSION_CANDIDATES.append(("zstd", 19))
+if brotli is not None:
+    COMPRESSION_CANDIDATES.append(("brotli", 11))
+
+def choose_codec(sample):
+    """Return the (codec, level) candidate that shrinks sample most, or ("none", 0)."""
+    best, best_size = ("none", 0), len(sample)
+    for codec, level in COMPRESSION_CANDIDATES:
+        size = len(COMPRESSORS[codec](sample, level))
+        if size < best_size:
+            best, best_size = (codec, level), size
+    if best_size > len(sample) * COMPRESS_MIN_GAIN:
+        return "none", 0
+    return best
+
+class Compressor:
+    """Incremental compression for any COMPRESSORS codec."""
+
+    def __init__(self, codec, level):
+        self.codec = codec
+        if codec == "gzip":
+            self.obj = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        elif codec == "zlib":
+            self.obj = zlib.compressobj(level)
+        elif codec == "bz2":
+            self.obj = bz2.BZ2Compressor(level)
+        elif codec == "lzma":
+            self.obj = lzma.LZMACompressor(format=lzma.FORMAT_ALONE, preset=level)
+        elif codec == "zstd":
+            self.obj = zstandard.ZstdCompressor(level=level).compressobj()
+        elif codec == "brotli":
+            self.obj = brotli.Compressor(quality=level)
+        else:
+            self.obj = None
+
+    def compress(self, data):
+        if self.obj is None:
+            return data
+        if self.codec == "brotli":
+            return self.obj.process(data)
+        return self.obj.compress(data)
+
+    def flush(self):
+        if self.obj is None:
+            return b""
+        if self.codec == "brotli":
+            return self.obj.finish()
+        return self.obj.flush()
+
+def compress_file(src, dst, codec, level):
+    """Stream the open file src into dst through Compressor, SPOOL_BLOCK at a time."""
+    compressor = Compressor(codec, level)
+    for block in iter(lambda: src.read(SPOOL_BLOCK), b""):
+        dst.write(compressor.compress(block))
+    dst.write(compressor.flush())
+
+class Decompressor:
+    """Incremental decompression for any COMPRESSORS codec."""
+
+    def __init__(self, codec):
+        self.codec = codec
+        if codec == "gzip":
+            self.obj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif codec == "zlib":
+            self.obj = zlib.decompressobj()
+        elif codec == "bz2":
+            self.obj = bz2.BZ2Decompressor()
+        elif codec == "lzma":
+            self.obj = lzma.LZMADecompressor()
+        elif codec == "zstd" and zstandard is not None:
+            self.obj = zstandard.ZstdDecompressor().decompressobj()
+        elif codec == "brotli" and brotli is not None:
+            self.obj = brotli.Decompressor()
+        elif codec == "none":
+            self.obj = None
+        else:
+            raise ValueError(f"Compression codec not available: {codec}")
+
+    def decompress(self, data):
+        if self.obj is None:
+            return data
+        if self.codec == "brotli":
+            return self.obj.process(data)
+        return self.obj.decompress(data)
+
+    def finish(self):
+        """Return (remaining output, whether the stream ended cleanly)."""
+        if self.obj is None:
+            return b"", True
+        if self.codec in ("gzip", "zlib"):
+            tail = self.obj.flush()
+            return tail, self.obj.eof
+        if self.codec == "zstd":
+            return self.obj.flush(), getattr(self.obj, "eof", True)
+        if self.codec == "brotli":
+            return b"", self.obj.is_finished()
+        return b"", self.obj.eof
+
+def pack_compressed(src, dst):
+    """Write src adaptively compressed into a tagged container (before encryption)."""
+    codec, level = choose_codec(src.read(COMPRESS_SAMPLE))
+    src.seek(0)
+    name = codec.encode("ascii")
+    dst.write(COMPRESSED_MAGIC + bytes([len(name)]) + name)
+    compress_file(src, dst, codec, level)
+    return codec
+
+def unpack_compressed_file(src, dst):
+    """Undo pack_compressed(); data without the tag is copied as-is (older files)."""
+    head = src.read(len(COMPRESSED_MAGIC))
+    if head != COMPRESSED_MAGIC:
+        dst.write(head)
+        for block in iter(lambda: src.read(SPOOL_BLOCK), b""):
+            dst.write(block)
+        return
+    size = src.read(1)[0]
+    inflater = Decompressor(src.read(size).decode("ascii"))
+    for block in iter(lambda: src.read(SPOOL_BLOCK), b""):
+        dst.write(inflater.decompress(block))
+    tail, ok = inflater.finish()
+    if not ok:
+        raise ValueError("Truncated compressed data")
+    dst.write(tail)
+
+# ------------------
+# AES encryption
+# ------------------
+def derive_key(password: str, salt: bytes, iterations: int):
+    kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=salt, iterations=iterations)
+    return kdf.derive(password.encode('utf-8'))
+
+def aes_encrypt_file(src, dst, password: str, chunk: int):
+    """Encrypt src into dst as SLA1: AES-256-GCM segments aligned to `chunk`-byte chunks.
+
+    Format: SLA1 + header length (2) + salt (16) + PBKDF2 rounds (4) +
+    nonce prefix (7) + segment size (4) + chunk size (2), zero-padded to a
+    whole number of chunks, then the sealed segments. Every segment spans
+    exactly AES_SEGMENT_CHUNKS chunks (the last one may be shorter), so it
+    can be verified as soon as those chunks are in.
+    """
+    salt = os.urandom(16)
+    prefix = os.urandom(AEAD_PREFIX_SIZE)
+    segment = AES_SEGMENT_CHUNKS * chunk - AEAD_TAG_SIZE
+    fields = (salt + AES_KDF_ITERATIONS.to_bytes(4, "big") + prefix
+              + segment.to_bytes(4, "big") + chunk.to_bytes(2, "big"))
+    header_len = -(-(len(AES_SEGMENTED_MAGIC) + 2 + len(fields)) // chunk) * chunk
+    header = (AES_SEGMENTED_MAGIC + header_len.to_bytes(2, "big") + fields).ljust(header_len, b"\0")
+    dst.write(header)
+    key = derive_key(password, salt, AES_KDF_ITERATIONS)
+    seal_segments(src, dst, key, prefix, header, segment)
+
+def aes_decrypt_file(src, dst, password: str):
+    """Decrypt an SLA1 file, or a legacy MAC + IV + CFB one, from src into dst.
+
+    Raises CorruptSegments (with the affected chunk ranges) when only some
+    segments fail authentication.
+    """
+    data = map_file(src)
+    try:
+        if data[:len(AES_SEGMENTED_MAGIC)] != AES_SEGMENTED_MAGIC:
+            dst.write(aes_decrypt(data[:], password))
+            return
+        header_len = int.from_bytes(data[4:6], "big")
+        header = data[:header_len]
+        salt, iterations, prefix, segment, chunk = parse_aes_header(header)
+        key = derive_key(password, salt, iterations)
+        bad = open_segments(data, header_len, dst, key, prefix, header, segment)
+        count = segment_count(len(data) - header_len, segment)
+        if bad and len(bad) == count:
+            raise ValueError("Wrong password or corrupted file")
+        if bad:
+            sealed = segment + AEAD_TAG_SIZE
+            chunks = set()
+            for index in bad:
+                lo = header_len + index * sealed
+                hi = min(lo + sealed, len(data))
+                chunks.update(range(lo // chunk, (hi - 1) // chunk + 1))
+            raise CorruptSegments(bad, sorted(chunks))
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
+
+def parse_aes_header(header):
+    """(salt, PBKDF2 rounds, nonce prefix, segment size, chunk size) of an SLA1 header."""
+    return (header[6:22], int.from_bytes(header[22:26], "big"), header[26:26 + AEAD_PREFIX_SIZE],
+            int.from_bytes(header[33:37], "big"), int.from_bytes(header[37:39], "big"))
+
+def aes_decrypt(data: bytes, password: str):
+    if len(data) < 48:  # MAC(32) + IV(16) minimum
+        raise ValueError("Invalid encrypted data: too short")
+
+    key = password.encode('utf-8')
+    key = (key * 32)[:32]
+
+    # Extract components
+    mac = data[:32]
+    iv = data[32:48]
+    ciphertext = data[48:]
+
+    # Verify HMAC
+    h = hmac.HMAC(key, hashes.SHA256(), backend=default_backend())
+    h.update(iv + ciphertext)
+    try:
+        h.verify(mac)
+    except Exception:
+        raise ValueError("Wrong password or corrupted file")
+
+    # Decrypt
+    cipher = Cipher(algorithms.AES(key), modes.CFB(iv), backend=default_backend())
+    decryptor = cipher.decryptor()
+    return decryptor.update(ciphertext) + decryptor.finalize()
+
+# ------------------
+# RSA encryption
+# ------------------
+def rsa_encrypt(data: bytes, pubkey_pem: str):
+    pubkey = serialization.load_pem_public_key(pubkey_pem.encode())
+    return pubkey.encrypt(data,
+                          padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()),
+                                       algorithm=hashes.SHA256(),
+                                       label=None))
+
+def rsa_decrypt(data: bytes, privkey_path: str, password=None):
+    with open(privkey_path, "rb") as f:
+        privkey = serialization.load_pem_private_key(f.read(), password=password.encode() if password else None)
+    return privkey.decrypt(data,
+                           padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()),
+                                        algorithm=hashes.SHA256(),
+                                        label=None))
+
+def rsa_encrypt_file(src, dst, pubkey_pem: str):
+    """Hybrid RSA: one OAEP-wrapped AES-256 data key, then the body in AES-GCM segments.
+
+    Format: SLR1 + key length (2) + wrapped key + nonce prefix (7) +
+    segment size (4), then the sealed segments. The header is the
+    associated data of every segment.
+    """
+    key = AESGCM.generate_key(bit_length=256)
+    wrapped = rsa_encrypt(key, pubkey_pem)
+    prefix = os.urandom(AEAD_PREFIX_SIZE)
+    header = (RSA_ENVELOPE_MAGIC + len(wrapped).to_bytes(2, "big") + wrapped
+              + prefix + AEAD_SEGMENT.to_bytes(4, "big"))
+    dst.write(header)
+    seal_segments(src, dst, key, prefix, header, AEAD_SEGMENT)
+
+def rsa_decrypt_file(src, dst, privkey_path: str, password=None):
+    """Open an SLR1 envelope; older .rsa files (whole-file OAEP) are still accepted."""
+    data = map_file(src)
+    try:
+        if data[:len(RSA_ENVELOPE_MAGIC)] != RSA_ENVELOPE_MAGIC:
+            dst.write(rsa_decrypt(data[:], privkey_path, password))
+            return
+        size = int.from_bytes(data[4:6], "big")
+        wrapped = data[6:6 + size]
+        prefix = data[6 + size:6 + size + AEAD_PREFIX_SIZE]
+        header_len = 6 + size + AEAD_PREFIX_SIZE + 4
+        segment = int.from_bytes(data[header_len - 4:header_len], "big")
+        key = rsa_decrypt(wrapped, privkey_path, password)
+        bad = open_segments(data, header_len, dst, key, prefix, data[:header_len], segment)
+        if bad:
+            raise CorruptSegments(bad)
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
+
+# ------------------
+# Authenticated segments
+# ------------------
+def segment_nonce(prefix, index, last):
+    # Counter and last flag in the nonce: segments cannot be reordered or dropped,
+    # and a file cut at a segment boundary fails on its new final segment
+    return prefix + index.to_bytes(4, "big") + (b"\1" if last else b"\0")
+
+def seal_segments(src, dst, key, prefix, aad, segment):
+    """AES-GCM encrypt src into dst, `segment` plaintext bytes at a time."""
+    aead = AESGCM(key)
+    block = src.read(segment)
+    index = 0
+    while True:
+        following = src.read(segment)
+        last = not following
+        dst.write(aead.encrypt(segment_nonce(prefix, index, last), block, aad))
+        if last:
+            return
+        block = following
+        index += 1
+
+def segment_count(length, segment):
+    """Sealed segments in `length` bytes of ciphertext (an empty body is one empty segment)."""
+    return max(-(-length // (segment + AEAD_TAG_SIZE)), 1)
+
+def open_segments(data, start, dst, key, prefix, aad, segment, workers=None):
+    """Verify and decrypt the sealed segments in data[start:] on a thread pool.
+
+    Plaintext of the good segments is written to dst in order; returns the
+    indices of the segments that failed authentication.
+    """
+    workers = workers or DECRYPT_WORKERS
+    sealed = segment + AEAD_TAG_SIZE
+    count = segment_count(len(data) - start, segment)
+    aead = AESGCM(key)
+
+    def open_one(index):
+        lo = start + index * sealed
+        try:
+            return aead.decrypt(segment_nonce(prefix, index, index == count - 1), data[lo:lo + sealed], aad)
+        except InvalidTag:
+            return None
+
+    bad = []
+    indices = iter(range(count))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # Keep a bounded number of segments in flight so memory stays flat
+        pending = deque(pool.submit(open_one, i) for i in itertools.islice(indices, workers * 2))
+        index = 0
+        while pending:
+            plaintext = pending.popleft().result()
+            for i in itertools.islice(indices, 1):
+                pending.append(pool.submit(open_one, i))
+            if plaintext is None:
+                bad.append(index)
+            else:
+                dst.write(plaintext)
+            index += 1
+    return bad
+
+class CorruptSegments(ValueError):
+    """Some segments failed authentication; the others decrypted fine."""
+
+    def __init__(self, segments, chunks=None):
+        self.segments = segments
+        self.chunks = chunks
+        super().__init__(f"{len(segments)} corrupt segment(s): {format_ranges(segments)}")
+
+class SegmentVerifier:
+    """Authenticates the segments of an SLA1 file while it is being received.
+
+    The SLA1 header fills whole chunks and each segment spans
+    AES_SEGMENT_CHUNKS chunks, so a segment is opened as soon as its last
+    chunk is in. Only chunks of opened segments are released to the output.
+    A segment that fails is dropped, and its chunks count as missing again.
+    Until one segment opens, a failure may just mean a wrong password, so
+    failures are held back; if none ever opens, the file is kept unverified.
+    """
+
+    def __init__(self, transfer, password):
+        self.transfer = transfer
+        self.password = password
+        self.aead = None
+        self.first = 0  # chunks taken by the header
+        self.count = 0
+        self.opened = set()
+        self.held = set()  # failures before the password was proven
+        self.dropped = 0
+        self.released = 0  # segments [0, released) are all opened
+        self.disabled = False
+
+    def limit(self):
+        """Chunks below this index are verified and may be written out."""
+        if self.disabled:
+            return self.transfer.total
+        if self.aead is None:
+            return 0
+        return min(self.first + self.released * AES_SEGMENT_CHUNKS, self.transfer.total)
+
+    def check(self, indices):
+        transfer = self.transfer
+        if self.disabled:
+            return
+        if self.aead is None:
+            if not self._start():
+                return
+            indices = range(transfer.total)  # chunks that arrived before the header
+        segments = {(i - self.first) // AES_SEGMENT_CHUNKS for i in indices if self.first <= i < transfer.total}
+        for segment in sorted(segments - self.opened):
+            self._open(segment)
+        if not self.opened and self.held and transfer.complete():
+            self.disabled = True
+            print(f"\n   ⚠️ The password opens no segment of {transfer.name}: keeping it unverified")
+
+    def _start(self):
+        """Derive the key once the header chunks are in; False while they are not."""
+        transfer = self.transfer
+        if not transfer.has(0):
+            return False
+        head = transfer._read(0)
+        if head[:len(AES_SEGMENTED_MAGIC)] != AES_SEGMENTED_MAGIC:
+            self.disabled = True  # legacy format: nothing to check until decryption
+            return False
+        header_len = int.from_bytes(head[4:6], "big")
+        salt, iterations, prefix, segment, chunk = parse_aes_header(head)
+        if chunk != transfer.chunk or header_len % chunk:
+            self.disabled = True
+            print(f"\n   ⚠️ {transfer.name} was encrypted for {chunk}-byte chunks: segments checked on decryption")
+            return False
+        self.first = header_len // chunk
+        if not all(transfer.has(i) for i in range(self.first)):
+            return False
+        self.header = b"".join(transfer._read(i) for i in range(self.first))
+        self.prefix = prefix
+        self.count = segment_count(transfer.length - header_len, segment)
+        print(f"\n   🔑 Verifying {transfer.name} segment by segment as it arrives")
+        self.aead = AESGCM(derive_key(self.password, salt, iterations))
+        return True
+
+    def _open(self, segment):
+        transfer = self.transfer
+        lo = self.first + segment * AES_SEGMENT_CHUNKS
+        chunks = range(lo, min(lo + AES_SEGMENT_CHUNKS, transfer.total))
+        if not all(transfer.has(i) for i in chunks):
+            return
+        sealed = b"".join(transfer._read(i) for i in chunks)
+        try:
+            self.aead.decrypt(segment_nonce(self.prefix, segment, segment == self.count - 1), sealed, self.header)
+        except InvalidTag:
+            if self.opened:
+                self._drop(segment, chunks)
+            else:
+                self.held.add(segment)
+            return
+        self.opened.add(segment)
+        while self.released in self.opened:
+            self.released += 1
+        for held in sorted(self.held):
+            lo = self.first + held * AES_SEGMENT_CHUNKS
+            self._drop(held, range(lo, min(lo + AES_SEGMENT_CHUNKS, transfer.total)))
+        self.held.clear()
+
+    def _drop(self, segment, chunks):
+        for i in chunks:
+            self.transfer.discard(i)
+        self.dropped += 1
+        print(f"\n   ⚠️ Segment {segment} failed authentication: chunks {chunks.start}-{chunks.stop - 1} "
+              f"are missing again")
+
+# ------------------
+# Send text messages
+# ------------------
+def send_text():
+    print("📝 Enter messages (one per line). Double enter to finish, Ctrl+C to cancel.")
+    messages = []
+    try:
+        while True:
+            msg = input("Message: ").strip()
+            if not msg and messages:
+                break
+            if msg:
+                messages.append(msg)
+    except KeyboardInterrupt:
+        print("\n⏹️ Input cancelled.")
+        return
+    if not messages:
+        print("❌ No messages entered.")
+        return
+    send_messages(messages)
+
+def send_messages(messages):
+    try:
+        with TxSession() as session:
+            pacer = Pacer()
+            for i, (msg, waveform) in enumerate(zip(messages, render_ahead(messages)), 1):
+                tx_message(waveform, session)
+                session.pause(pacer.gap(waveform))
+                print(f"✅ Message {i} sent: {msg[:50]}{'...' if len(msg)>50 else ''}")
+            session.report()
+    except KeyboardInterrupt:
+        print("\n⏹️ Transmission interrupted.")
+
+# ------------------
+# Chunk framing
+# ------------------
+def pack_frame(tid, index, total, data):
+    head = tid.to_bytes(2, "big") + index.to_bytes(3, "big") + total.to_bytes(3, "big")
+    crc = binascii.crc_hqx(head + data, 0)
+    return head + crc.to_bytes(2, "big") + data
+
+def unpack_frame(raw):
+    """Return (tid, index, total, data), or None if the frame is short or fails its CRC."""
+    if len(raw) < FRAME_HEADER_SIZE:
+        return None
+    head, crc, data = raw[:8], raw[8:10], raw[10:]
+    if binascii.crc_hqx(head + data, 0) != int.from_bytes(crc, "big"):
+        return None
+    return (int.from_bytes(head[:2], "big"), int.from_bytes(head[2:5], "big"),
+            int.from_bytes(head[5:8], "big"), data)
+
+# ------------------
+# Payload codecs
+# ------------------
+# How framed bytes become a ggwave payload. The binding may only take str
+# (sent as UTF-8), so the densest safe choice packs 7 bits per character.
+_ACCEPTS_BYTES = None
+
+def ggwave_accepts_bytes():
+    """Whether this ggwave binding round-trips arbitrary bytes (probed once)."""
+    global _ACCEPTS_BYTES
+    if _ACCEPTS_BYTES is None:
+        probe = bytes([0, 0x80, 0xff]) + b"sonarlink"
+        try:
+            raw = ggwave.encode(probe, protocolId=PROTOCOL_ID, volume=VOLUME)
+        except (AttributeError, TypeError, ValueError):
+            _ACCEPTS_BYTES = False
+        else:
+            _ACCEPTS_BYTES = decode_offline(bytes(raw)) == [probe]
+    return _ACCEPTS_BYTES
+
+def b128_encode(data):
+    bits = np.unpackbits(np.frombuffer(data, dtype=np.uint8))
+    bits = np.concatenate([bits, np.zeros(-len(bits) % 7, dtype=np.uint8)]).reshape(-1, 7)
+    values = bits @ (1 << np.arange(6, -1, -1))
+    return values.astype(np.uint8).tobytes().decode("ascii")
+
+def b128_decode(wire):
+    values = np.frombuffer(wire, dtype=np.uint8)
+    if (values > 0x7f).any():
+        raise ValueError("not a b128 payload")
+    bits = np.unpackbits(values.reshape(-1, 1), axis=1)[:, 1:].ravel()
+    return np.packbits(bits[:len(bits) // 8 * 8]).tobytes()
+
+def b64_decode(wire):
+    return base64.b64decode(wire, validate=True)
+
+PAYLOAD_CODECS = {
+    # name: encode(bytes) -> payload, decode(wire bytes) -> bytes, bytes per N payload chars
+    "raw": {"encode": bytes, "decode": bytes, "capacity": lambda chars: chars},
+    "b128": {"encode": b128_encode, "decode": b128_decode, "capacity": lambda chars: chars * 7 // 8},
+    "b85": {"encode": lambda data: base64.b85encode(data).decode("ascii"), "decode": base64.b85decode,
+            "capacity": lambda chars: chars // 5 * 4 + max(chars % 5 - 1, 0)},
+    "b64": {"encode": lambda data: base64.b64encode(data).decode("ascii"), "decode": b64_decode,
+            "capacity": lambda chars: chars // 4 * 3},
+}
+
+def frame_codec(profile):
+    """The profile's "codec", or the densest one this binding supports."""
+    if profile.get("codec"):
+        return profile["codec"]
+    return "raw" if ggwave_accepts_bytes() else "b128"
+
+def encode_frame(frame, codec):
+    return PAYLOAD_CODECS[codec]["encode"](frame)
+
+def parse_frame(wire, codec):
+    try:
+        raw = PAYLOAD_CODECS[codec]["decode"](wire)
+    except (binascii.Error, ValueError):
+        return None
+    return unpack_frame(raw)
+
+def chunk_capacity(profile, codec=None):
+    """Stream bytes carried by one data frame once framed and encoded."""
+    codec = codec or frame_codec(profile)
+    return PAYLOAD_CODECS[codec]["capacity"](profile["payload"]) - FRAME_HEADER_SIZE
+
+def transfer_id(name, stream, chunk_size, opts=""):
+    # Deterministic so a resend of the same file lines up with the receiver's state;
+    # the name keeps identical files sent under different names apart
+    h = hashlib.sha256(stream)
+    h.update(chunk_size.to_bytes(2, "big") + opts.encode() + b"\0" + name.encode())
+    return int.from_bytes(h.digest()[:2], "big")
+
+def file_header(tid, total, chunk_size, length, name, payload, opts=""):
+    head = f"FILE:{tid:04x}:{total}:{chunk_size}:{length}:{opts}:"
+    room = payload - len(head)
+    if len(name) > room:
+        stem, ext = os.path.splitext(name)
+        name = stem[:max(room - len(ext), 1)] + ext[:max(room - 1, 0)]
+    return head + name
+
+def parse_file_header(text):
+    """Parse a FILE: header into a dict, or None if it is malformed."""
+    parts = text[5:].split(":", 5)
+    if len(parts) != 6:
+        return None
+    try:
+        return {"tid": int(parts[0], 16), "total": int(parts[1]), "chunk": int(parts[2]),
+                "length": int(parts[3]), "opts": parts[4], "name": parts[5].strip()}
+    except ValueError:
+        return None
+
+def received_name(name):
+    """The file name a received transfer is saved under: no directories, never "." or ".."."""
+    name = os.path.basename(name.replace("\\", "/"))
+    return "received.bin" if name in ("", ".", "..") else name
+
+def format_ranges(indices):
+    """[1, 2, 3, 7] -> "1-3,7" """
+    ranges = []
+    for _, group in itertools.groupby(enumerate(indices), lambda p: p[1] - p[0]):
+        group = [i for _, i in group]
+        ranges.append(str(group[0]) if len(group) == 1 else f"{group[0]}-{group[-1]}")
+    return ",".join(ranges)
+
+def parse_ranges(text):
+    indices = set()
+    for part in text.replace(" ", "").split(","):
+        if not part:
+            continue
+        if "-" in part:
+            lo, hi = part.split("-", 1)
+            indices.update(range(int(lo), int(hi) + 1))
+        else:
+            indices.add(int(part))
+    return sorted(indices)
+
+# ------------------
+# Forward error correction
+# ------------------
+# Systematic Reed-Solomon erasure code over GF(256): each group of k data
+# chunks gets m parity chunks from a Cauchy matrix, and any k of the k+m
+# chunks rebuild the group.
+GF_EXP = np.zeros(512, dtype=np.uint8)
+GF_LOG = np.zeros(256, dtype=np.int32)
+_x = 1
+for _i in range(255):
+    GF_EXP[_i] = _x
+    GF_LOG[_x] = _i
+    _x <<= 1
+    if _x & 0x100:
+        _x ^= 0x11d
+GF_EXP[255:510] = GF_EXP[:255]
+del _x, _i
+
+def gf_mul(a, b):
+    if a == 0 or b == 0:
+        return 0
+    return int(GF_EXP[GF_LOG[a] + GF_LOG[b]])
+
+def gf_inv(a):
+    return int(GF_EXP[255 - GF_LOG[a]])
+
+def gf_scale(coef, vec):
+    """coef * vec for a uint8 vector."""
+    if coef == 0:
+        return np.zeros_like(vec)
+    out = GF_EXP[GF_LOG[vec] + GF_LOG[coef]]
+    out[vec == 0] = 0
+    return out
+
+def fec_coefficient(k, j, i):
+    # Cauchy entry 1 / (x_j + y_i) with x_j = k + j and y_i = i (disjoint sets)
+    return gf_inv((k + j) ^ i)
+
+def fec_encode(blocks, k, m):
+    """Parity blocks for one group of equal-length data blocks."""
+    vecs = [np.frombuffer(b, dtype=np.uint8) for b in blocks]
+    parity = []
+    for j in range(m):
+        acc = np.zeros_like(vecs[0])
+        for i, vec in enumerate(vecs):
+            acc ^= gf_scale(fec_coefficient(k, j, i), vec)
+        parity.append(acc.tobytes())
+    return parity
+
+def fec_recover(count, k, data, parity):
+    """Rebuild a group of `count` data blocks from any `count` data/parity blocks.
+
+    `data` maps data position -> block, `parity` maps parity row -> block;
+    returns the missing data blocks by position.
+    """
+    missing = [i for i in range(count) if i not in data]
+    rows = [[int(i == c) for c in range(count)] for i in sorted(data)]
+    rhs = [np.frombuffer(data[i], dtype=np.uint8) for i in sorted(data)]
+    for j in sorted(parity)[:len(missing)]:
+        rows.append([fec_coefficient(k, j, c) for c in range(count)])
+        rhs.append(np.frombuffer(parity[j], dtype=np.uint8))
+    if len(rows) < count:
+        raise ValueError("not enough chunks to rebuild the group")
+    # Gauss-Jordan elimination over GF(256), carrying the block vectors along
+    for col in range(count):
+        pivot = next(r for r in range(col, count) if rows[r][col])
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        rhs[col], rhs[pivot] = rhs[pivot], rhs[col]
+        inv = gf_inv(rows[col][col])
+        rows[col] = [gf_mul(inv, v) for v in rows[col]]
+        rhs[col] = gf_scale(inv, rhs[col])
+        for r in range(count):
+            factor = rows[r][col]
+            if r != col and factor:
+                rows[r] = [a ^ gf_mul(factor, b) for a, b in zip(rows[r], rows[col])]
+                rhs[r] = rhs[r] ^ gf_scale(factor, rhs[col])
+    return {i: rhs[i].tobytes() for i in missing}
+
+def parse_opts(opts):
+    return dict(item.split("=", 1) for item in opts.split(",") if "=" in item)
+
+def parse_fec(value):
+    """"8+2" -> (8, 2)"""
+    if not value:
+        return None
+    k, m = value.split("+")
+    return int(k), int(m)
+
+def fec_parity_count(total, fec):
+    if not fec:
+        return 0
+    k, m = fec
+    return (total + k - 1) // k * m
+
+def iter_chunks(stream, size, total, fec=None):
+    """Yield (index, data) in transmission order.
+
+    With FEC, a group's parity follows the next group's data so a single
+    noise burst cannot wipe out both a group's tail and its parity.
+    """
+    if not fec:
+        for i in range(total):
+            yield i, stream[i*size:(i+1)*size]
+        return
+    k, m = fec
+    delayed = []
+    for g in range(0, total, k):
+        blocks = []
+        for i in range(g, min(g + k, total)):
+            data = stream[i*size:(i+1)*size]
+            blocks.append(data.ljust(size, b"\0"))
+            yield i, data
+        yield from delayed
+        delayed = [(total + g // k * m + j, block) for j, block in enumerate(fec_encode(blocks, k, m))]
+    yield from delayed
+
+# ------------------
+# Send files
+# ------------------
+def transmit_stream(name, stream, session, compression, verbose=False, profile=None, only=None,
+                    archive=False, delta=False):
+    """Send FILE header, framed chunks and ENDFILE over an open TxSession.
+
+    `compression` names the codec `stream` was compressed with; `only`
+    restricts the data/parity frames to those chunk indices (resend);
+    `archive` marks a batch archive the receiver unpacks into a directory,
+    `delta` a patch for the receiver's stored copy of `name`.
+    """
+    profile = profile or get_profile()
+    pacer = Pacer(profile)
+    started, start_frames = time.perf_counter(), session.frames_written
+    header, tid, codec, size, total_chunks, frames_total = transfer_plan(name, stream, profile, compression,
+                                                                         archive, delta)
+    fec = profile.get("fec")
+    chunks = iter_chunks(stream, size, total_chunks, fec)
+    count = frames_total
+    if only is not None:
+        wanted = set(only)
+        chunks = ((i, data) for i, data in chunks if i in wanted)
+        count = len(wanted & set(range(frames_total)))
+    print(f"   📤 Sending {count}/{frames_total} chunks of max {size} bytes "
+          f"({codec} frames, transfer {tid:04x})...")
+    if fec:
+        print(f"   🛡️ FEC {fec[0]}+{fec[1]}: {frames_total - total_chunks} parity chunks "
+              f"(+{(frames_total - total_chunks) / total_chunks:.0%} airtime)")
+    if profile.get("lanes"):
+        send_striped(header, chunks, count, tid, total_chunks, codec, session, profile)
+        transfer_sent(tid, name, len(stream), count, session, started, start_frames)
+        return tid
+    for_render, for_progress = itertools.tee(chunks)
+    frames = (encode_frame(pack_frame(tid, i, total_chunks, data), codec) for i, data in for_render)
+    waveforms = render_ahead(itertools.chain([header], frames, ["ENDFILE"]), profile)
+    waveform = next(waveforms)
+    tx_message(waveform, session)
+    if verbose:
+        print(f"   ✓ Sent filename")
+    session.pause(pacer.gap(waveform, control=True))
+    for chunk_count, (index, data) in enumerate(for_progress, 1):
+        waveform = next(waveforms)
+        tx_message(waveform, session)
+        session.pause(pacer.gap(waveform, control=chunk_count == count))
+        if verbose:
+            kind = "parity chunk" if index >= total_chunks else "chunk"
+            print(f"   ✓ Sent {kind} {index + 1}/{frames_total}: {len(data)} bytes")
+        else:
+            print(f"   📊 Sent chunk {chunk_count}/{count}", end="\r")
+    if verbose:
+        print(f"   ✓ All {count} chunks sent")
+    else:
+        print()
+    waveform = next(waveforms)
+    tx_message(waveform, session)
+    if verbose:
+        print(f"   ✓ Sent ENDFILE")
+    session.pause(pacer.gap(waveform, control=True))
+    if verbose:
+        print(f"   ✓ Total inter-frame silence: {pacer.total:.1f} s")
+    transfer_sent(tid, name, len(stream), count, session, started, start_frames)
+    return tid
+
+def transfer_sent(tid, name, length, chunks, session, started, start_frames):
+    """Telemetry for a finished send: airtime from the samples written, goodput per second of it."""
+    airtime = (session.frames_written - start_frames) / SAMPLE_RATE
+    goodput = length / airtime if airtime else 0.0
+    METRICS.count("transfers_total", direction="tx", result="sent")
+    METRICS.gauge("goodput_bytes_per_second", goodput, direction="tx")
+    METRICS.event("transfer_tx", tid=f"{tid:04x}", name=name, bytes=length, chunks=chunks,
+                  airtime_s=round(airtime, 3), wall_s=round(time.perf_counter() - started, 3),
+                  goodput_bps=round(goodput, 2))
+    METRICS.flush()
+
+def check_frame_count(name, frames_total, size, fec):
+    """Refuse a transfer whose chunk indices would not fit in the frame header."""
+    if frames_total > MAX_FRAMES:
+        data = MAX_FRAMES * size * (fec[0] / (fec[0] + fec[1]) if fec else 1)
+        raise ValueError(f"{name} is too large for one transfer: {frames_total} frames needed, "
+                         f"at most {MAX_FRAMES} (about {data / 2**30:.2f} GB of compressed data with "
+                         f"{size}-byte chunks{' and FEC' if fec else ''}): split it{' or pick a profile without FEC' if fec else ''}")
+
+def transfer_plan(name, stream, profile, compression, archive=False, delta=False):
+    """Return (FILE header, transfer id, payload codec, chunk size, data chunks, data + parity frames)."""
+    codec = frame_codec(profile)
+    size = chunk_capacity(profile, codec)
+    fec = profile.get("fec")
+    total_chunks = max((len(stream) + size - 1) // size, 1)
+    frames_total = total_chunks + fec_parity_count(total_chunks, fec)
+    check_frame_count(name, frames_total, size, fec)
+    opts = f"c={codec},z={compression}" + (f",fec={fec[0]}+{fec[1]}" if fec else "")
+    opts += (",arc=1" if archive else "") + (",dlt=1" if delta else "")
+    tid = transfer_id(name, stream, size, opts)
+    header = file_header(tid, total_chunks, size, len(stream), name, profile["payload"], opts)
+    return header, tid, codec, size, total_chunks, frames_total
+
+def stripe_order(steps):
+    """Endless lane sequence for frames `steps[lane]` samples apart (frame plus gap).
+
+    Each frame goes to the lane whose cursor is earliest, ties to the lowest
+    lane, so a faster protocol carries proportionally more frames. The
+    order is fixed before rendering, from these estimated steps.
+    """
+    cursors = [0] * len(steps)
+    while True:
+        lane = cursors.index(min(cursors))
+        cursors[lane] += steps[lane]
+        yield lane
+
+def send_striped(header, chunks, count, tid, total, codec, session, profile):
+    """Play a framed transfer over all of the profile's lanes at once.
+
+    Chunks are dealt to lanes by stripe_order(), from each lane's frame and
+    gap length, so a faster protocol carries proportionally more; frames
+    then render ahead in that order. Lanes sharing a channel are mixed
+    into one buffer. FILE and ENDFILE go out on the first lane alone.
+    """
+    lanes = profile["lanes"]
+    lane_profiles = [{**profile, "protocol": protocol} for _, protocol in lanes]
+    pacers = [Pacer(p) for p in lane_profiles]
+    mixer = StripeMixer(session, lanes)
+    print("   🔀 Striping over " + ", ".join(f"ch{channel} {PROTOCOL_NAMES[protocol]}" for channel, protocol in lanes))
+    frames = (encode_frame(pack_frame(tid, index, total, data), codec) for index, data in chunks)
+    first = next(frames, None)
+    frames = itertools.chain([first], frames) if first is not None else iter(())
+    # Lanes are picked before rendering so the frames can render ahead like transmit_stream's;
+    # the first frame on every lane gives the per-lane step the mixer would see
+    steps = []
+    if first is not None:
+        for lane_profile in lane_profiles:
+            probe = prepare_waveform(first, lane_profile)
+            steps.append(len(probe) // BYTES_PER_FRAME + int(Pacer(lane_profile).gap(probe) * SAMPLE_RATE))
+    waveform = prepare_waveform(header, lane_profiles[0])
+    mixer.place(0, waveform, pacers[0].gap(waveform, control=True))
+    mixer.sync()
+    order = stripe_order(steps)
+    waveforms = render_ahead(frames, profiles=(lane_profiles[lane] for lane in stripe_order(steps)))
+    for chunk_count, waveform in enumerate(waveforms, 1):
+        lane = next(order)
+        mixer.place(lane, waveform, pacers[lane].gap(waveform))
+        print(f"   📊 Sent chunk {chunk_count}/{count} (lane {lane + 1}/{len(lanes)})", end="\r")
+    print()
+    mixer.sync(pacers[0].settle)
+    waveform = prepare_waveform("ENDFILE", lane_profiles[0])
+    mixer.place(0, waveform, pacers[0].gap(waveform, control=True))
+    mixer.finish()
+
+ENCRYPTED_SUFFIXES = (".aes", ".rsa")
+
+def map_file(f):
+    """Read-only memory map of an open file (b"" when empty, which mmap refuses)."""
+    f.flush()
+    if os.fstat(f.fileno()).st_size == 0:
+        return b""
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+class OutgoingFile:
+    """A file ready to send: compressed into a spool file and memory-mapped.
+
+    `data` slices like bytes, so framing reads only the chunk in hand and
+    the file is never held in memory whole. Encrypted files were compressed
+    before encryption and are mapped as-is. Every codec is deterministic,
+    so a resend rebuilds the same stream.
+    """
+
+    def __init__(self, fname):
+        self.size = os.path.getsize(fname)
+        self.source = open(fname, "rb")
+        self.spool = None
+        if fname.endswith(ENCRYPTED_SUFFIXES):
+            self.codec, level = "none", 0
+        else:
+            self.codec, level = choose_codec(self.source.read(COMPRESS_SAMPLE))
+            self.source.seek(0)
+        if self.codec == "none":
+            self.data = map_file(self.source)
+        else:
+            self.spool = tempfile.TemporaryFile()
+            compress_file(self.source, self.spool, self.codec, level)
+            self.data = map_file(self.spool)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        if self.spool is not None:
+            self.spool.close()
+        self.source.close()
+
+def resend_chunks():
+    print("🔁 Resend missing chunks (use the ranges printed by the receiver)")
+    try:
+        fname = input("File that was sent (.aes/.rsa for encrypted sends, "
+                      "the same comma-separated list for a batch archive): ").strip()
+        ranges = input("Missing chunks (e.g. 3,17-19): ").strip()
+    except KeyboardInterrupt:
+        print("\n⏹️ Operation cancelled.")
+        return
+    try:
+        indices = parse_ranges(ranges)
+    except ValueError:
+        print("❌ Invalid chunk ranges")
+        return
+    if "," in fname or os.path.isdir(fname):
+        send_batch([p.strip() for p in fname.split(",") if p.strip()], only=indices)
+        return
+    if not os.path.exists(fname):
+        print("❌ File not found")
+        return
+    try:
+        with OutgoingFile(fname) as outgoing, TxSession() as session:
+            transmit_stream(os.path.basename(fname), outgoing.data, session, only=indices, compression=outgoing.codec)
+            session.report()
+    except ValueError as e:
+        print(f"❌ {e}")
+        return
+    print(f"✅ Resend complete: {fname}")
+
+def send_file():
+    print("📁 Send file")
+    print("1. Unencrypted files (multiple files)")
+    print("2. AES encryption (1 file)")
+    print("3. RSA encryption (1 file)")
+    print("4. Resend missing chunks")
+    print("5. Half-duplex send with ACK/NACK (1 file)")
+    print("6. Batch archive (files and directories as one stream)")
+    print("7. Delta send (only what changed since the last send to a receiver)")
+    print("8. Carousel broadcast (loop one transfer until Ctrl+C)")
+    try:
+        choice = input("Choice (1-8): ").strip()
+    except KeyboardInterrupt:
+        print("\n⏹️ Operation cancelled.")
+        return
+
+    if choice == "1":
+        try:
+            files = input("Files separated by comma: ").split(",")
+            files = [f.strip() for f in files if f.strip()]
+        except KeyboardInterrupt:
+            print("\n⏹️ Operation cancelled.")
+            return
+        send_files(files)
+
+    elif choice == "2" and HAS_CRYPTO:
+        try:
+            fname = input("File to encrypt: ").strip()
+            password = input("AES password: ").strip()
+        except KeyboardInterrupt:
+            print("\n⏹️ Operation cancelled.")
+            return
+        if not os.path.exists(fname):
+            print("❌ File not found")
+            return
+        file_size = os.path.getsize(fname)
+        if file_size > MAX_FILE_SIZE:
+            print(f"❌ File too large ({file_size} bytes, max {MAX_FILE_SIZE})")
+            return
+        save_name = fname + ".aes"
+        with open(fname, "rb") as src, tempfile.TemporaryFile() as packed, open(save_name, "wb") as out:
+            pack_compressed(src, packed)
+            packed_size = packed.tell()
+            packed.seek(0)
+            aes_encrypt_file(packed, out, password, chunk_capacity(get_profile()))
+        print(f"✅ AES file saved: {save_name}")
+        try:
+            send_now = input("Send it now? (y/N): ").strip().lower()
+        except KeyboardInterrupt:
+            print("\n⏹️ Transmission cancelled.")
+            return
+        if send_now == "y":
+            print(f"   🔍 Original file: {file_size} bytes")
+            print(f"   🔍 Compressed before encryption: {packed_size} bytes")
+            print(f"   🔍 Encrypted: {os.path.getsize(save_name)} bytes")
+            try:
+                with OutgoingFile(save_name) as outgoing, TxSession() as session:
+                    transmit_stream(os.path.basename(save_name), outgoing.data, session, verbose=True,
+                                    compression=outgoing.codec)
+                    session.report()
+            except ValueError as e:
+                print(f"❌ {e}")
+                return
+            print(f"✅ AES file sent: {save_name}")
+
+    elif choice == "3" and HAS_CRYPTO:
+        try:
+            fname = input("File to encrypt: ").strip()
+            pubkey_path = input("Public key PEM path: ").strip()
+        except KeyboardInterrupt:
+            print("\n⏹️ Operation cancelled.")
+            return
+        if not os.path.exists(fname) or not os.path.exists(pubkey_path):
+            print("❌ File or key not found")
+            return
+        file_size = os.path.getsize(fname)
+        if file_size > MAX_FILE_SIZE:
+            print(f"❌ File too large ({file_size} bytes, max {MAX_FILE_SIZE})")
+            return
+        with open(pubkey_path, "r") as kf:
+            pubkey_pem = kf.read()
+        save_name = fname + ".rsa"
+        with open(fname, "rb") as src, tempfile.TemporaryFile() as packed, open(save_name, "wb") as out:
+            pack_compressed(src, packed)
+            packed.seek(0)
+            rsa_encrypt_file(packed, out, pubkey_pem)
+        print(f"✅ RSA file saved: {save_name}")
+        try:
+            send_now = input("Send it now? (y/N): ").strip().lower()
+        except KeyboardInterrupt:
+            print("\n⏹️ Transmission cancelled.")
+            return
+        if send_now == "y":
+            try:
+                with OutgoingFile(save_name) as outgoing, TxSession() as session:
+                    transmit_stream(os.path.basename(save_name), outgoing.data, session, compression=outgoing.codec)
+                    session.report()
+            except ValueError as e:
+                print(f"❌ {e}")
+                return
+            print(f"✅ RSA file sent: {save_name}")
+
+    elif choice == "4":
+        resend_chunks()
+
+    elif choice == "5":
+        send_duplex()
+
+    elif choice == "6":
+        try:
+            paths = input("Files or directories separated by comma: ").split(",")
+            paths = [p.strip() for p in paths if p.strip()]
+        except KeyboardInterrupt:
+            print("\n⏹️ Operation cancelled.")
+            return
+        send_batch(paths)
+
+    elif choice == "7":
+        try:
+            receiver = input("Receiver name (e.g. lab-2): ").strip()
+            files = input("Files separated by comma: ").split(",")
+            files = [f.strip() for f in files if f.strip()]
+            ranges = input("Missing chunks to resend (Enter for a new send): ").strip()
+        except KeyboardInterrupt:
+            print("\n⏹️ Operation cancelled.")
+            return
+        try:
+            only = parse_ranges(ranges) if ranges else None
+        except ValueError:
+            print("❌ Invalid chunk ranges")
+            return
+        send_delta(files, receiver, only)
+
+    elif choice == "8":
+        try:
+            paths = input("File, or files and directories separated by comma: ").split(",")
+            paths = [p.strip() for p in paths if p.strip()]
+        except KeyboardInterrupt:
+            print("\n⏹️ Operation cancelled.")
+            return
+        send_carousel(paths)
+
+    else:
+        print("❌ Invalid option or cryptography not available")
+
+def send_files(files, only=None):
+    """Send each file as its own transfer; returns the number sent."""
+    sent = 0
+    with TxSession() as session:
+        for fname in files:
+            if not os.path.exists(fname):
+                print(f"❌ File not found: {fname}")
+                continue
+            file_size = os.path.getsize(fname)
+            if file_size > MAX_FILE_SIZE:
+                print(f"❌ File too large: {fname} ({file_size} bytes, max {MAX_FILE_SIZE})")
+                continue
+            with OutgoingFile(fname) as outgoing:
+                print(f"   🗜️ {outgoing.codec}: {outgoing.size} → {len(outgoing.data)} bytes")
+                try:
+                    transmit_stream(os.path.basename(fname), outgoing.data, session, only=only,
+                                    compression=outgoing.codec)
+                except ValueError as e:
+                    print(f"❌ {e}")
+                    continue
+            print(f"✅ File sent: {fname}")
+            sent += 1
+        session.report()
+    return sent
+
+# ------------------
+# Batch archives
+# ------------------
+# Many files sent as one transfer: a single FILE/ENDFILE exchange and one
+# compression dictionary for the lot. The stream is ARCHIVE_MAGIC, the
+# manifest length (4 bytes), a JSON manifest of names, sizes and SHA-256
+# hashes, then every file's bytes in manifest order.
+def archive_entries(paths):
+    """Return (archive name, [(path on disk, name in archive)]) for files and directories.
+
+    Directory contents are listed in sorted order under the directory's
+    name, so the same inputs always give the same stream (and transfer id).
+    """
+    entries = []
+    for path in paths:
+        path = os.path.normpath(path)
+        if os.path.isdir(path):
+            base = os.path.basename(os.path.abspath(path))
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for fname in sorted(files):
+                    full = os.path.join(root, fname)
+                    rel = os.path.relpath(full, path).replace(os.sep, "/")
+                    entries.append((full, f"{base}/{rel}" if len(paths) > 1 else rel))
+        elif os.path.isfile(path):
+            entries.append((path, os.path.basename(path)))
+        else:
+            raise ValueError(f"File not found: {path}")
+    names = [name for _, name in entries]
+    if len(set(names)) != len(names):
+        raise ValueError("Two inputs share a name inside the archive; send them separately")
+    if len(paths) == 1 and os.path.isdir(paths[0]):
+        return os.path.basename(os.path.abspath(paths[0])), entries
+    return "batch", entries
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(SPOOL_BLOCK), b""):
+            h.update(block)
+    return h.hexdigest()
+
+class OutgoingArchive:
+    """A batch archive ready to send, compressed into a memory-mapped spool file.
+
+    Like OutgoingFile, with `name` (the directory the receiver unpacks
+    into) and `manifest`.
+    """
+
+    def __init__(self, paths):
+        self.name, entries = archive_entries(paths)
+        self.manifest = [{"name": name, "size": os.path.getsize(path), "sha256": file_digest(path)}
+                         for path, name in entries]
+        index = json.dumps(self.manifest, separators=(",", ":")).encode()
+        header = ARCHIVE_MAGIC + struct.pack(">I", len(index)) + index
+        self.size = len(header) + sum(entry["size"] for entry in self.manifest)
+        if self.size > MAX_FILE_SIZE:
+            raise ValueError(f"Archive too large ({self.size} bytes, max {MAX_FILE_SIZE})")
+        self.codec, level = choose_codec(header + self._head(entries, COMPRESS_SAMPLE))
+        self.spool = tempfile.TemporaryFile()
+        compressor = Compressor(self.codec, level)
+        self.spool.write(compressor.compress(header))
+        for path, _ in entries:
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(SPOOL_BLOCK), b""):
+                    self.spool.write(compressor.compress(block))
+        self.spool.write(compressor.flush())
+        self.data = map_file(self.spool)
+
+    @staticmethod
+    def _head(entries, limit):
+        """The first `limit` bytes of the concatenated files, to choose a codec on."""
+        sample = bytearray()
+        for path, _ in entries:
+            if len(sample) >= limit:
+                break
+            with open(path, "rb") as f:
+                sample += f.read(limit - len(sample))
+        return bytes(sample)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.spool.close()
+
+def send_batch(paths, only=None):
+    """Send files and directories as one archive transfer; returns True when sent."""
+    try:
+        outgoing = OutgoingArchive(paths)
+    except (OSError, ValueError) as e:
+        print(f"❌ {e}")
+        return False
+    with outgoing, TxSession() as session:
+        print(f"   📚 Archive {outgoing.name}: {len(outgoing.manifest)} files, "
+              f"{outgoing.codec}: {outgoing.size} → {len(outgoing.data)} bytes")
+        try:
+            transmit_stream(outgoing.name, outgoing.data, session, only=only,
+                            compression=outgoing.codec, archive=True)
+        except ValueError as e:
+            print(f"❌ {e}")
+            return False
+        session.report()
+    print(f"✅ Archive sent: {outgoing.name} ({len(outgoing.manifest)} files)")
+    return True
+
+# ------------------
+# Delta transfers
+# ------------------
+# Files are cut into content-defined chunks (boundaries follow the bytes,
+# so an insertion only disturbs the chunks around it). The sender keeps,
+# per receiver and file name, the chunk hashes of the version it last
+# sent; a new version goes out as DELTA_MAGIC, a JSON header and a list
+# of ops: "C" + offset (8) + length (4) copies from the receiver's stored
+# copy, "L" + length (4) + bytes carries new data.
+GEAR = np.array([int.from_bytes(hashlib.sha256(bytes([i])).digest()[:4], "big") for i in range(256)],
+                dtype=np.uint32)
+
+def gear_hashes(data):
+    """Gear rolling hash over a 32-byte window at every position of a uint8 array.
+
+    h[i] = sum(GEAR[data[i - k]] << k for k < 32), built by doubling the
+    window five times rather than stepping byte by byte.
+    """
+    h = GEAR[data]
+    width = 1
+    while width < 32:
+        shifted = np.zeros_like(h)
+        shifted[width:] = h[:-width] << np.uint32(width)
+        h += shifted
+        width *= 2
+    return h
+
+def content_chunks(data):
+    """Yield (offset, length) content-defined chunks of a bytes-like object."""
+    low, high = DELTA_CHUNK_RANGE
+    start = 0
+    for begin in range(0, len(data), SPOOL_BLOCK):
+        # 31 bytes of history so hashes do not depend on where blocks start
+        lead = min(begin, 31)
+        block = np.frombuffer(data[begin - lead:begin + SPOOL_BLOCK], dtype=np.uint8)
+        hashes = gear_hashes(block)[lead:]
+        for cut in np.flatnonzero((hashes & np.uint32(DELTA_CHUNK_MASK)) == 0) + begin + 1:
+            while cut - start > high:
+                yield start, high
+                start += high
+            if cut - start >= low:
+                yield start, int(cut) - start
+                start = int(cut)
+        while begin + len(hashes) - start > high:
+            yield start, high
+            start += high
+    if start < len(data):
+        yield start, len(data) - start
+
+def chunk_digest(block):
+    return hashlib.sha256(block).digest()[:16].hex()
+
+def delta_record(data):
+    """Chunk hashes, size and SHA-256 of one version of a file, as kept in the manifest."""
+    whole = hashlib.sha256()
+    chunks = []
+    for offset, length in content_chunks(data):
+        block = data[offset:offset + length]
+        whole.update(block)
+        chunks.append([chunk_digest(block), length])
+    return {"size": len(data), "sha256": whole.hexdigest(), "chunks": chunks}
+
+def delta_manifest_path(receiver, name):
+    if not receiver or not all(c.isalnum() or c in "-_." for c in receiver) or receiver.startswith("."):
+        raise ValueError(f"Receiver name must be letters, digits, '-', '_' or '.': {receiver!r}")
+    return os.path.join(DELTA_STATE, receiver, name + ".json")
+
+def load_delta_record(receiver, name):
+    path = delta_manifest_path(receiver, name)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def save_delta_record(receiver, name, record):
+    path = delta_manifest_path(receiver, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(record, f, separators=(",", ":"))
+    os.replace(path + ".tmp", path)
+
+def write_delta(data, record, base, dst):
+    """Write the delta turning `base` (a manifest record) into `data`; returns (copied, literal) bytes."""
+    index = {}
+    offset = 0
+    for digest, length in base["chunks"]:
+        index.setdefault(digest, (offset, length))
+        offset += length
+    header = json.dumps({"base": base["sha256"], "size": record["size"], "sha256": record["sha256"]}).encode()
+    dst.write(DELTA_MAGIC + struct.pack(">I", len(header)) + header)
+    copied = literal = 0
+    run = None  # pending copy, merged while the base offsets stay contiguous
+    offset = 0
+    for digest, length in record["chunks"]:
+        found = index.get(digest)
+        if found is not None and found[1] == length:
+            if run is not None and run[0] + run[1] == found[0]:
+                run[1] += length
+            else:
+                if run is not None:
+                    dst.write(b"C" + struct.pack(">QI", *run))
+                run = [found[0], length]
+            copied += length
+        else:
+            if run is not None:
+                dst.write(b"C" + struct.pack(">QI", *run))
+                run = None
+            dst.write(b"L" + struct.pack(">I", length) + data[offset:offset + length])
+            literal += length
+        offset += length
+    if run is not None:
+        dst.write(b"C" + struct.pack(">QI", *run))
+    return copied, literal
+
+class CompressingWriter:
+    """File-like wrapper compressing everything written into an open file."""
+
+    def __init__(self, dst, codec, level):
+        self.dst = dst
+        self.compressor = Compressor(codec, level)
+
+    def write(self, data):
+        self.dst.write(self.compressor.compress(data))
+
+    def close(self):
+        self.dst.write(self.compressor.flush())
+
+def send_delta(files, receiver, only=None):
+    """Send each file as a delta against what `receiver` last got from us.
+
+    Returns the number of files sent or already up to date.
+
+    Files never sent to that receiver go in full. A resend (`only`) rebuilds
+    the delta against the same base as the original send.
+    """
+    sent = 0
+    with TxSession() as session:
+        for fname in files:
+            if not os.path.exists(fname):
+                print(f"❌ File not found: {fname}")
+                continue
+            file_size = os.path.getsize(fname)
+            if file_size > MAX_FILE_SIZE:
+                print(f"❌ File too large: {fname} ({file_size} bytes, max {MAX_FILE_SIZE})")
+                continue
+            name = os.path.basename(fname)
+            try:
+                previous = load_delta_record(receiver, name)
+            except ValueError as e:
+                print(f"❌ {e}")
+                return sent
+            try:
+                record, base = send_delta_file(fname, name, receiver, previous, session, only)
+            except ValueError as e:
+                print(f"❌ {e}")
+                continue
+            if record is None:
+                sent += 1  # unchanged since the last send
+                continue
+            if only is None:
+                record["base"] = {key: base[key] for key in ("size", "sha256", "chunks")} if base else None
+                save_delta_record(receiver, name, record)
+            print(f"✅ File sent: {fname}")
+            sent += 1
+        session.report()
+    return sent
+
+def send_delta_file(fname, name, receiver, previous, session, only):
+    """Transmit one file of send_delta(); returns (record, base), or (None, None) when unchanged."""
+    with open(fname, "rb") as source:
+        data = map_file(source)
+        try:
+            record = delta_record(data)
+            base = previous
+            if previous is not None and previous["sha256"] == record["sha256"]:
+                if only is None:
+                    print(f"   ✓ {name} unchanged since the last send to {receiver}, skipped")
+                    return None, None
+                base = previous.get("base")  # resend of the delta already sent
+            if base is None:
+                print(f"   Δ {name}: first send to {receiver}, sending in full")
+                with OutgoingFile(fname) as outgoing:
+                    transmit_stream(name, outgoing.data, session, only=only, compression=outgoing.codec)
+            else:
+                codec, level = choose_codec(data[:COMPRESS_SAMPLE])
+                with tempfile.TemporaryFile() as spool:
+                    writer = CompressingWriter(spool, codec, level)
+                    copied, literal = write_delta(data, record, base, writer)
+                    writer.close()
+                    stream = map_file(spool)
+                    print(f"   Δ {name}: {copied} bytes reused, {literal} new, "
+                          f"{codec}: {len(stream)} bytes on air")
+                    try:
+                        transmit_stream(name, stream, session, only=only, compression=codec, delta=True)
+                    finally:
+                        if isinstance(stream, mmap.mmap):
+                            stream.close()
+            return record, base
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+
+# ------------------
+# Broadcast carousel
+# ------------------
+def render_carousel(name, stream, profile, compression, archive, reel):
+    """Record one carousel cycle into the open file `reel`; returns (transfer id, frames per cycle).
+
+    A cycle holds every data and parity frame with its pacing gap, and the
+    FILE header every CAROUSEL_HEADER_EVERY frames so late joiners pick the
+    transfer up quickly. There is no ENDFILE: a receiver finishes as soon
+    as its last missing chunk comes round again.
+    """
+    header, tid, codec, size, total, frames_total = transfer_plan(name, stream, profile, compression, archive)
+    pacer = Pacer(profile)
+
+    def frames():
+        for n, (index, data) in enumerate(iter_chunks(stream, size, total, profile.get("fec"))):
+            if n % CAROUSEL_HEADER_EVERY == 0:
+                yield header, True
+            yield encode_frame(pack_frame(tid, index, total, data), codec), False
+
+    count = frames_total + (frames_total + CAROUSEL_HEADER_EVERY - 1) // CAROUSEL_HEADER_EVERY
+    for_render, for_flags = itertools.tee(frames())
+    with TxSession(SpoolOutput(reel)) as recorder:
+        waveforms = render_ahead((message for message, _ in for_render), profile)
+        for n, (waveform, (_, control)) in enumerate(zip(waveforms, for_flags), 1):
+            recorder.send(waveform)
+            recorder.pause(pacer.gap(waveform, control=control))
+            print(f"   🎞️ Rendered frame {n}/{count}", end="\r")
+    print()
+    return tid, count
+
+def send_carousel(paths, cycles=None):
+    """Broadcast one transfer in a loop until Ctrl+C (or for `cycles` passes).
+
+    The cycle is rendered once into a spool file; every later pass only
+    copies samples to the output, so receivers that join late or miss
+    frames fill in from the next pass at no encoding cost.
+    """
+    profile = get_profile()
+    if profile.get("lanes"):
+        print("❌ The carousel plays a single lane: pick a profile without lanes")
+        return False
+    try:
+        if len(paths) == 1 and os.path.isfile(paths[0]):
+            if os.path.getsize(paths[0]) > MAX_FILE_SIZE:
+                raise ValueError(f"File too large: {paths[0]} (max {MAX_FILE_SIZE} bytes)")
+            outgoing, name, archive = OutgoingFile(paths[0]), os.path.basename(paths[0]), False
+        else:
+            outgoing = OutgoingArchive(paths)
+            name, archive = outgoing.name, True
+    except (OSError, ValueError) as e:
+        print(f"❌ {e}")
+        return False
+    played = 0
+    with outgoing, tempfile.TemporaryFile() as reel_file:
+        started = time.process_time()
+        try:
+            tid, frames = render_carousel(name, outgoing.data, profile, outgoing.codec, archive, reel_file)
+        except ValueError as e:
+            print(f"❌ {e}")
+            return False
+        reel = map_file(reel_file)
+        cycle = len(reel) / (BYTES_PER_FRAME * SAMPLE_RATE)
+        print(f"   🎠 Carousel of {name} (transfer {tid:04x}): {frames} frames, {cycle / 60:.1f} min per cycle, "
+              f"rendered in {time.process_time() - started:.1f} s CPU")
+        print(f"   Looping {f'{cycles} times' if cycles else 'until Ctrl+C'}...")
+        try:
+            with TxSession() as session:
+                while cycles is None or played < cycles:
+                    session.write(reel, messages=frames)
+                    played += 1
+                    print(f"   🎠 Cycle {played} complete", end="\r")
+        except KeyboardInterrupt:
+            print("\n⏹️ Carousel stopped.")
+        finally:
+            if isinstance(reel, mmap.mmap):
+                reel.close()
+    print(f"\n✅ Carousel played {played} full cycle(s) of {name}")
+    print(f"   🧊 Waveform cache: {WAVEFORMS.summary()}")
+    return True
+
+# ------------------
+# Half-duplex ACK/NACK transfers
+# ------------------
+class AckListener:
+    """AudioCapture handler on the sender that collects ACK frames for one transfer."""
+
+    def __init__(self):
+        self.tid = None  # set by transmit_duplex()
+        self.acks = queue.Queue()
+
+    def on_frame(self, res):
+        text = res.decode("utf-8", errors="ignore")
+        if self.tid is not None and text.startswith(f"ACK:{self.tid:04x}:"):
+            self.acks.put(text)
+
+    def on_idle(self):
+        pass
+
+    def clear(self):
+        while not self.acks.empty():
+            self.acks.get_nowait()
+
+    def wait(self, lo, timeout):
+        """Return the set of acknowledged indices for a window starting at lo, or None."""
+        deadline = time.time() + timeout
+        while True:
+            try:
+                text = self.acks.get(timeout=max(deadline - time.time(), 0.01))
+            except queue.Empty:
+                return None
+            _, _, ack_lo, bitmap = text.split(":", 3)
+            if int(ack_lo) != lo:
+                continue  # stale reply to an earlier window
+            bits = int(bitmap, 16)
+            return {lo + i for i in range(bits.bit_length()) if bits >> i & 1}
+
+def ack_text(tid, lo, indices):
+    bits = 0
+    for i in indices:
+        bits |= 1 << (i - lo)
+    return f"ACK:{tid:04x}:{lo}:{bits:x}"
+
+def transmit_duplex(name, stream, session, listener, compression, profile=None):
+    """Send a stream in ACK windows, retransmitting only NACKed chunks.
+
+    Window size and pacing adapt to the loss rate each ACK reports: a clean
+    window grows the window and tightens the gaps, a lossy one halves the
+    window and backs the gaps off again.
+    """
+    profile = profile or get_profile()
+    pacer = Pacer(profile)
+    codec = frame_codec(profile)
+    size = chunk_capacity(profile, codec)
+    total = max((len(stream) + size - 1) // size, 1)
+    check_frame_count(name, total, size, None)
+    opts = f"c={codec},z={compression},ack=1"
+    tid = listener.tid = transfer_id(name, stream, size, opts)
+    header = file_header(tid, total, size, len(stream), name, profile["payload"], opts)
+    ack_timeout = 2.0 + 2 * waveform_duration(prepare_waveform(ack_text(tid, 0, range(DUPLEX_MAX_SPAN)), profile))
+    window = DUPLEX_WINDOW
+    acked = set()
+    sent = set()
+    retransmitted = 0
+    lowest = 0
+    next_fresh = 0
+    print(f"   📤 Half-duplex send: {total} chunks of max {size} bytes (transfer {tid:04x})")
+    tx_message(prepare_waveform(header, profile), session)
+    session.pause(pacer.settle)
+    while len(acked) < total:
+        while lowest in acked:
+            lowest += 1
+        # NACKed chunks first, then fresh ones, within what one ACK bitmap can describe
+        batch = [i for i in range(lowest, next_fresh) if i not in acked][:window]
+        while len(batch) < window and next_fresh < total and next_fresh - lowest < DUPLEX_MAX_SPAN:
+            batch.append(next_fresh)
+            next_fresh += 1
+        retransmitted += len(sent.intersection(batch))
+        sent.update(batch)
+        frames = [encode_frame(pack_frame(tid, i, total, stream[i*size:(i+1)*size]), codec) for i in batch]
+        for waveform in render_ahead(frames, profile):
+            tx_message(waveform, session)
+            session.pause(pacer.gap(waveform))
+        lo, hi = batch[0], batch[-1]
+        got = None
+        for attempt in range(DUPLEX_RETRIES):
+            listener.clear()
+            if attempt:
+                tx_message(prepare_waveform(header, profile), session)  # the header may be what got lost
+            tx_message(prepare_waveform(f"WIN:{tid:04x}:{lo}:{hi}", profile), session)
+            got = listener.wait(lo, ack_timeout)
+            if got is not None:
+                break
+            print(f"\n   ⚠️ No ACK for window {lo}-{hi} (attempt {attempt + 1}/{DUPLEX_RETRIES})")
+        if got is None:
+            print(f"❌ Receiver stopped answering: {len(acked)}/{total} chunks acknowledged")
+            return False
+        acked |= got & set(range(total))
+        missed = [i for i in batch if i not in got]
+        loss = len(missed) / len(batch)
+        if not missed:
+            window = min(window + 2, DUPLEX_WINDOW_RANGE[1])
+            pacer.scale = max(pacer.scale * 0.8, DUPLEX_PACING_RANGE[0])
+        elif loss > 0.1:
+            window = max(window // 2, DUPLEX_WINDOW_RANGE[0])
+            pacer.scale = min(pacer.scale * 1.5, DUPLEX_PACING_RANGE[1])
+        print(f"   📊 ACK {len(acked)}/{total}: window {lo}-{hi} lost {len(missed)}/{len(batch)}, "
+              f"next window {window}, pacing x{pacer.scale:.2f}", end="\r")
+    print()
+    tx_message(prepare_waveform("ENDFILE", profile), session)
+    session.pause(pacer.settle)
+    print(f"   ✓ {total} chunks acknowledged, {retransmitted} retransmitted")
+    return True
+
+def send_duplex():
+    print("🔄 Half-duplex send: the receiver must answer ACKs (Receive → y)")
+    if TRANSPORT["kind"] != "audio":
+        print("❌ Half-duplex needs live audio: switch the transport back to audio (menu 6)")
+        return
+    try:
+        fname = input("File to send: ").strip()
+    except KeyboardInterrupt:
+        print("\n⏹️ Operation cancelled.")
+        return
+    if not os.path.exists(fname):
+        print("❌ File not found")
+        return
+    file_size = os.path.getsize(fname)
+    if file_size > MAX_FILE_SIZE:
+        print(f"❌ File too large ({file_size} bytes, max {MAX_FILE_SIZE})")
+        return
+    profile = get_profile()
+    outgoing = OutgoingFile(fname)
+    listener = AckListener()
+    capture = AudioCapture(listener)
+    try:
+        capture.start()
+    except Exception as e:
+        print("Error opening microphone:", e)
+        outgoing.close()
+        return
+    try:
+        with TxSession() as session:
+            if transmit_duplex(os.path.basename(fname), outgoing.data, session, listener, outgoing.codec, profile):
+                print(f"✅ File sent: {fname}")
+            session.report()
+    except ValueError as e:
+        print(f"❌ {e}")
+    except KeyboardInterrupt:
+        print("\n⏹️ Transmission interrupted.")
+    finally:
+        capture.stop()
+        outgoing.close()
+
+# ------------------
+# Pacing calibration
+# ------------------
+def calibration_frame(gap, index, size):
+    head = f"CAL:{int(gap * 1000):04d}:{index:02d}:"
+    return head + "#" * (size - len(head))
+
+def calibrate_pacing():
+    """Send full-size test frames at shrinking gaps; a listening receiver reports what survived."""
+    profile = get_profile()
+    print(f"📏 Pacing calibration for profile '{ACTIVE_PROFILE}' ({PROTOCOL_NAMES[profile['protocol']]})")
+    print("   Start option 3 (Receive) on the other machine first.")
+    try:
+        input("Press Enter to start, Ctrl+C to cancel...")
+    except KeyboardInterrupt:
+        print("\n⏹️ Calibration cancelled.")
+        return
+    frames = [(gap, i) for gap in CALIBRATION_GAPS for i in range(CALIBRATION_REPEATS)]
+    messages = [calibration_frame(gap, i, profile["payload"]) for gap, i in frames]
+    messages.append(f"CALEND:{CALIBRATION_REPEATS}")
+    try:
+        with TxSession() as session:
+            waveforms = render_ahead(messages, profile)
+            for n, ((gap, i), waveform) in enumerate(zip(frames, waveforms), 1):
+                tx_message(waveform, session)
+                session.pause(gap)
+                print(f"   📊 Gap {gap * 1000:.0f} ms: frame {i + 1}/{CALIBRATION_REPEATS} ({n}/{len(frames)})", end="\r")
+            print()
+            session.pause(1.0)
+            tx_message(next(waveforms), session)
+    except KeyboardInterrupt:
+        print("\n⏹️ Calibration interrupted.")
+        return
+    print("✅ Calibration frames sent. Read the recommended gap on the receiver.")
+
+def calibration_report(counts, repeats):
+    """Print per-gap receive rates and return the shortest gap that never dropped a frame."""
+    print("\n📏 Calibration results:")
+    best = None
+    for gap in sorted(CALIBRATION_GAPS, reverse=True):
+        got = counts.get(gap, 0)
+        print(f"   {gap * 1000:5.0f} ms gap: {got}/{repeats} frames")
+        if got < repeats:
+            break
+        best = gap
+    if best is None:
+        print("❌ Even the longest gap lost frames: check volume and distance.")
+    else:
+        print(f"✅ Shortest reliable gap: {best * 1000:.0f} ms (set \"gap\": {best} in the profile's pacing)")
+    return best
+
+# ------------------
+# Protocol benchmark
+# ------------------
+def decode_offline(waveform, trailing=1.0):
+    """Run a rendered waveform through a fresh ggwave decoder, no audio device."""
+    instance = ggwave.init()
+    data = waveform + b"\0" * (int(trailing * SAMPLE_RATE) * BYTES_PER_FRAME)
+    chunk_bytes = CHUNK_SIZE * BYTES_PER_FRAME
+    decoded = []
+    try:
+        for i in range(0, len(data), chunk_bytes):
+            res = ggwave.decode(instance, data[i:i+chunk_bytes])
+            if res:
+                decoded.append(res)
+    finally:
+        ggwave.free(instance)
+    return decoded
+
+def benchmark_protocols(payload_size=GGWAVE_MAX_BYTES, trials=None, snr_db=BENCHMARK_SNR, rng=None):
+    """Render a random payload per trial through every protocol, add noise and decode it offline.
+
+    Trials render straight through ggwave, not the waveform cache, so every
+    one pays the full encode cost.
+    """
+    trials = trials or BENCHMARK_TRIALS
+    rng = rng or np.random.default_rng()
+    alphabet = np.frombuffer(b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789", dtype=np.uint8)
+    noise = "clean" if snr_db is None else f"SNR {snr_db} dB"
+    results = {}
+    print(f"⏱️ Benchmarking {len(PROTOCOL_NAMES)} protocols, {payload_size} byte payload, "
+          f"{trials} trials each, {noise}")
+    for protocol_id, protocol_name in PROTOCOL_NAMES.items():
+        profile = {"protocol": protocol_id, "volume": VOLUME, "payload": payload_size, "pacing": {}}
+        ok = 0
+        airtime = 0.0
+        encode = 0.0
+        try:
+            for _ in range(trials):
+                payload = rng.choice(alphabet, payload_size).tobytes().decode()
+                started = time.perf_counter()
+                waveform = render_waveform(payload, profile)
+                encode += time.perf_counter() - started
+                airtime = waveform_duration(waveform) + Pacer(profile).gap(waveform)
+                if snr_db is not None:
+                    waveform = add_noise(waveform, snr_db, rng)
+                if decode_offline(waveform) == [payload.encode()]:
+                    ok += 1
+        except Exception as e:
+            print(f"   {protocol_name:<19} ❌ cannot encode: {e}")
+            continue
+        rate = ok / trials
+        results[protocol_id] = (payload_size / airtime * rate, rate)
+        print(f"   {protocol_name:<19} {payload_size / airtime:6.1f} B/s  "
+              f"decode {ok}/{trials}  effective {results[protocol_id][0]:6.1f} B/s  "
+              f"encode {encode / trials * 1000:5.1f} ms")
+    usable = [name for name, p in PROFILES.items() if results.get(p["protocol"], (0, 0))[1] == 1.0]
+    if usable:
+        best = max(usable, key=lambda name: results[PROFILES[name]["protocol"]][0])
+        print(f"✅ Fastest profile that decoded every trial: {best}")
+        print("   Offline decoding ignores the room: confirm with option 5 (Calibrate pacing).")
+    return results
+
+def add_noise(samples, snr_db, rng):
+    """Add white noise snr_db below the RMS of the non-silent samples."""
+    x = np.frombuffer(samples, dtype=np.float32)
+    active = x[x != 0].astype(np.float64)
+    if not active.size:
+        return samples
+    sigma = np.sqrt(np.mean(active ** 2)) * 10 ** (-snr_db / 20)
+    return (x + rng.normal(0.0, sigma, x.size)).astype(np.float32).tobytes()
+
+def loopback_transfer(path, profile_name, snr_db=None, rng=None):
+    """Send a file over the loopback transport and receive it back in a scratch directory.
+
+    Returns (received bytes or None, stats) with encode/decode CPU seconds
+    and airtime. Profile and transport are restored afterwards.
+    """
+    global WAVEFORMS
+    saved_profile, saved_transport, saved_cache = ACTIVE_PROFILE, dict(TRANSPORT), WAVEFORMS
+    WAVEFORMS = WaveformCache(WAVEFORM_CACHE_BYTES)  # cold, so encode CPU is comparable across trials
+    workdir = tempfile.mkdtemp(prefix="sonarlink-rx-")
+    cwd = os.getcwd()
+    stats = {}
+    try:
+        set_profile(profile_name)
+        set_transport("loopback")
+        LOOPBACK.clear()
+        with contextlib.redirect_stdout(io.StringIO()):
+            started = time.process_time()
+            with OutgoingFile(path) as outgoing, TxSession() as session:
+                transmit_stream(os.path.basename(path), outgoing.data, session, compression=outgoing.codec)
+            stats["encode_cpu"] = time.process_time() - started
+            stats["airtime"] = len(LOOPBACK) / (BYTES_PER_FRAME * profile_channels()) / SAMPLE_RATE
+            if snr_db is not None:
+                LOOPBACK[:] = add_noise(bytes(LOOPBACK), snr_db, rng or np.random.default_rng())
+            os.chdir(workdir)
+            started = time.process_time()
+            receive(duplex=False)
+            stats["decode_cpu"] = time.process_time() - started
+        out = os.path.join(workdir, os.path.basename(path))
+        received = None
+        if os.path.exists(out):
+            with open(out, "rb") as f:
+                received = f.read()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+        LOOPBACK.clear()
+        set_profile(saved_profile)
+        TRANSPORT.update(saved_transport)
+        WAVEFORMS = saved_cache
+    return received, stats
+
+def benchmark_transfers(sizes=None, profiles=None, noise=None, trials=1, seed=0):
+    """End-to-end file transfers over the loopback transport, no devices and no waiting.
+
+    For each file size, profile and noise level: encode and decode CPU
+    time, airtime, success rate and effective bytes per second of airtime.
+    """
+    sizes = sizes or BENCHMARK_SIZES
+    profiles = profiles or list(PROFILES)
+    noise = BENCHMARK_NOISE if noise is None else noise
+    rng = np.random.default_rng(seed)
+    srcdir = tempfile.mkdtemp(prefix="sonarlink-bench-")
+    results = []
+    print(f"⏱️ End-to-end benchmark: {len(sizes)} sizes × {len(profiles)} profiles × {len(noise)} noise levels, "
+          f"{trials} trial(s) each")
+    print(f"   {'profile':<19} {'bytes':>6} {'SNR':>5} {'ok':>5} {'enc CPU':>8} {'dec CPU':>8} "
+          f"{'airtime':>8} {'realtime':>8} {'eff B/s':>8}")
+    try:
+        for size in sizes:
+            # Base64 of random bytes: compresses about as well as typical text
+            payload = base64.b64encode(rng.bytes(size))[:size]
+            path = os.path.join(srcdir, f"bench-{size}.bin")
+            with open(path, "wb") as f:
+                f.write(payload)
+            for name in profiles:
+                for snr in noise:
+                    ok = 0
+                    encode_cpu = decode_cpu = airtime = 0.0
+                    for _ in range(trials):
+                        received, stats = loopback_transfer(path, name, snr, rng)
+                        ok += received == payload
+                        encode_cpu += stats["encode_cpu"]
+                        decode_cpu += stats["decode_cpu"]
+                        airtime += stats["airtime"]
+                    row = {"profile": name, "size": size, "snr": snr, "ok": ok, "trials": trials,
+                           "encode_cpu": encode_cpu / trials, "decode_cpu": decode_cpu / trials,
+                           "airtime": airtime / trials, "rate": size * ok / airtime if airtime else 0.0}
+                    results.append(row)
+                    snr_label = "clean" if snr is None else f"{snr}dB"
+                    print(f"   {name:<19} {size:>6} {snr_label:>5} {ok:>2}/{trials:<2} {row['encode_cpu']:7.2f}s "
+                          f"{row['decode_cpu']:7.2f}s {row['airtime']:7.1f}s "
+                          f"{row['airtime'] / max(row['decode_cpu'], 1e-9):7.0f}x {row['rate']:8.1f}")
+    finally:
+        shutil.rmtree(srcdir, ignore_errors=True)
+    print("   Success rate per profile:")
+    for name in profiles:
+        rows = [r for r in results if r["profile"] == name]
+        done = sum(r["ok"] for r in rows)
+        runs = sum(r["trials"] for r in rows)
+        print(f"   {name:<19} {done}/{runs} ({done / runs:.0%})")
+    return results
+
+def choose_transport():
+    print(f"🔌 Audio transport (active: {TRANSPORT['kind']})")
+    print("1. audio     PyAudio speaker and microphone")
+    print("2. wav       Send writes a float32 WAV file, receive decodes one")
+    print("3. loopback  In-memory buffer: send, then receive in the same session")
+    try:
+        choice = input("Choice (1-3): ").strip()
+        kinds = {"1": "audio", "2": "wav", "3": "loopback"}
+        if choice not in kinds:
+            print("❌ Invalid option.")
+            return
+        path = None
+        if kinds[choice] == "wav":
+            path = input(f"WAV file [{TRANSPORT['path']}]: ").strip() or None
+    except KeyboardInterrupt:
+        print("\n⏹️ Operation cancelled.")
+        return
+    set_transport(kinds[choice], path)
+    print(f"✅ Transport: {TRANSPORT['kind']}" + (f" ({TRANSPORT['path']})" if TRANSPORT["kind"] == "wav" else ""))
+
+def run_benchmark_transfers():
+    try:
+        sizes = input(f"File sizes in bytes [{','.join(map(str, BENCHMARK_SIZES))}]: ").strip()
+        noise = input("Noise levels, SNR dB, 'clean' for none [clean,10,0,-5]: ").strip()
+        trials = input("Trials per combination [1]: ").strip()
+    except KeyboardInterrupt:
+        print("\n⏹️ Operation cancelled.")
+        return
+    try:
+        sizes = [int(x) for x in sizes.split(",")] if sizes else None
+        noise = [None if x.strip() == "clean" else float(x) for x in noise.split(",")] if noise else None
+        trials = int(trials) if trials else 1
+    except ValueError:
+        print("❌ Invalid number")
+        return
+    benchmark_transfers(sizes, noise=noise, trials=trials)
+
+def choose_profile():
+    print(f"🎛️ Transmission profiles (active: {ACTIVE_PROFILE})")
+    names = list(PROFILES)
+    for i, name in enumerate(names, 1):
+        p = PROFILES[name]
+        lanes = f", {len(p['lanes'])} lanes" if p.get("lanes") else ""
+        print(f"{i}. {name:<19} {PROTOCOL_NAMES[p['protocol']]:<19} vol {p['volume']}, {p['payload']} bytes/frame{lanes}")
+    print("b. Benchmark all protocols")
+    print("e. End-to-end transfer benchmark (loopback, with noise)")
+    print(f"t. Audio transport (active: {TRANSPORT['kind']})")
+    try:
+        choice = input(f"Choice (1-{len(names)}, b, e or t): ").strip().lower()
+    except KeyboardInterrupt:
+        print("\n⏹️ Operation cancelled.")
+        return
+    if choice == "b":
+        benchmark_protocols()
+    elif choice == "e":
+        run_benchmark_transfers()
+    elif choice == "t":
+        choose_transport()
+    elif choice.isdigit() and 1 <= int(choice) <= len(names):
+        set_profile(names[int(choice) - 1])
+        print(f"✅ Active profile: {ACTIVE_PROFILE}")
+    else:
+        print("❌ Invalid option.")
+
+# ------------------
+# Incremental file reassembly
+# ------------------
+class StreamingFileWriter:
+    """Decompress the transfer stream as it arrives, straight to disk.
+
+    Output goes to a temp file next to the target that is renamed on
+    finish(), so memory stays flat and finalizing a transfer is a rename.
+    """
+
+    def __init__(self, filename, temp_path, codec="gzip"):
+        self.filename = filename
+        self.temp_path = temp_path
+        self.codec = codec
+        self.inflater = Decompressor(codec)
+        self.out = self.open_output()
+        self.error = None
+        self.compressed = 0
+        self.written = 0
+
+    def feed(self, raw):
+        self.compressed += len(raw)
+        if self.error is not None:
+            return
+        try:
+            out = self.inflater.decompress(raw)
+        except Exception as e:  # each codec raises its own error type
+            self.error = e
+            return
+        self.out.write(out)
+        self.written += len(out)
+
+    def finish(self):
+        """Flush and rename into place; raises ValueError if the stream is bad or incomplete."""
+        ok = False
+        if self.error is None:
+            try:
+                tail, ok = self.inflater.finish()
+            except Exception as e:
+                self.error = e
+            else:
+                self.out.write(tail)
+                self.written += len(tail)
+        if not ok:
+            raise ValueError(f"bad {self.codec} stream: {self.error or 'incomplete'}")
+        return self.close_output()
+
+    def open_output(self):
+        return open(self.temp_path, "wb")
+
+    def close_output(self):
+        self.out.close()
+        os.replace(self.temp_path, self.filename)
+        return self.filename
+
+    def discard(self):
+        self.out.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+class ArchiveUnpacker:
+    """Parses a batch archive stream fed in pieces of any size, writing files under `root`.
+
+    Each file is written to `temp_path` and renamed into place as soon as
+    its last byte arrives and its SHA-256 matches the manifest; a mismatch
+    is kept as <name>.corrupted. Errors are recorded and raised by close().
+    """
+
+    def __init__(self, root, temp_path):
+        self.root = root
+        self.temp_path = temp_path
+        self.head = bytearray()  # bytes before the manifest is complete
+        self.manifest = None
+        self.index = -1  # manifest entry being written
+        self.remaining = 0
+        self.out = None
+        self.hasher = None
+        self.unpacked = []
+        self.bad = []
+        self.error = None
+
+    def write(self, data):
+        if self.error is not None:
+            return
+        try:
+            self._write(memoryview(data))
+        except (ValueError, OSError) as e:
+            self.error = e
+
+    def _write(self, view):
+        if self.manifest is None:
+            self.head += view
+            if len(self.head) < len(ARCHIVE_MAGIC) + 4:
+                return
+            if self.head[:len(ARCHIVE_MAGIC)] != ARCHIVE_MAGIC:
+                raise ValueError("not a batch archive")
+            size = struct.unpack(">I", self.head[len(ARCHIVE_MAGIC):len(ARCHIVE_MAGIC) + 4])[0]
+            start = len(ARCHIVE_MAGIC) + 4
+            if len(self.head) < start + size:
+                return
+            self.manifest = json.loads(bytes(self.head[start:start + size]))
+            for entry in self.manifest:
+                self.member_path(entry["name"])  # reject unsafe names before writing anything
+            view = memoryview(bytes(self.head[start + size:]))
+            self.head = None
+            self._next()
+        while len(view):
+            if self.out is None:
+                raise ValueError("data past the last file in the manifest")
+            piece = view[:self.remaining]
+            self.out.write(piece)
+            self.hasher.update(piece)
+            self.remaining -= len(piece)
+            view = view[len(piece):]
+            if self.remaining == 0:
+                self._close_member()
+                self._next()
+
+    def member_path(self, name):
+        parts = name.split("/")
+        if "\\" in name or ":" in name or any(part in ("", ".", "..") for part in parts):
+            raise ValueError(f"unsafe name in archive: {name!r}")
+        path = os.path.join(self.root, *parts)
+        root = os.path.realpath(self.root)
+        if not os.path.realpath(path).startswith(root + os.sep):
+            raise ValueError(f"unsafe name in archive: {name!r}")
+        return path
+
+    def _next(self):
+        """Open the next manifest entry, finishing empty files on the spot."""
+        while self.index + 1 < len(self.manifest):
+            self.index += 1
+            self.out = open(self.temp_path, "wb")
+            self.hasher = hashlib.sha256()
+            self.remaining = self.manifest[self.index]["size"]
+            if self.remaining:
+                return
+            self._close_member()
+        self.out = None
+
+    def _close_member(self):
+        entry = self.manifest[self.index]
+        self.out.close()
+        self.out = None
+        target = self.member_path(entry["name"])
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if self.hasher.hexdigest() == entry["sha256"]:
+            os.replace(self.temp_path, target)
+            self.unpacked.append(entry["name"])
+        else:
+            os.replace(self.temp_path, target + ".corrupted")
+            self.bad.append(entry["name"])
+
+    def close(self):
+        """Raise ValueError unless every file in the manifest arrived intact."""
+        self.discard()
+        if self.error is not None:
+            raise ValueError(str(self.error))
+        if self.manifest is None or len(self.unpacked) + len(self.bad) < len(self.manifest):
+            raise ValueError("archive ended early")
+        if self.bad:
+            raise ValueError(f"{len(self.bad)} file(s) failed the SHA-256 check: {', '.join(self.bad[:5])}")
+
+    def discard(self):
+        if self.out is not None:
+            self.out.close()
+            self.out = None
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+class ArchiveWriter(StreamingFileWriter):
+    """StreamingFileWriter for batch archives: unpacks into the `filename` directory as data arrives."""
+
+    def open_output(self):
+        return ArchiveUnpacker(self.filename, self.temp_path)
+
+    def close_output(self):
+        self.out.close()
+        os.makedirs(self.filename, exist_ok=True)  # even for an empty archive
+        return self.filename
+
+    def discard(self):
+        self.out.discard()
+
+class DeltaPatcher:
+    """Applies a delta stream fed in pieces of any size to the stored copy `filename`.
+
+    The new version is built in `temp_path` and replaces the stored copy
+    only once its size and SHA-256 match the delta header. Errors are
+    recorded and raised by close().
+    """
+
+    def __init__(self, filename, temp_path):
+        self.filename = filename
+        self.temp_path = temp_path
+        self.buffer = bytearray()
+        self.header = None
+        self.base = None
+        self.out = None
+        self.hasher = hashlib.sha256()
+        self.copied = 0
+        self.literal = 0
+        self.error = None
+
+    def write(self, data):
+        if self.error is not None:
+            return
+        self.buffer += data
+        try:
+            self._apply()
+        except (ValueError, OSError, struct.error) as e:
+            self.error = e
+
+    def _apply(self):
+        if self.header is None:
+            start = len(DELTA_MAGIC) + 4
+            if len(self.buffer) < start:
+                return
+            if self.buffer[:len(DELTA_MAGIC)] != DELTA_MAGIC:
+                raise ValueError("not a delta stream")
+            size = struct.unpack(">I", self.buffer[len(DELTA_MAGIC):start])[0]
+            if len(self.buffer) < start + size:
+                return
+            self.header = json.loads(bytes(self.buffer[start:start + size]))
+            del self.buffer[:start + size]
+            if not os.path.exists(self.filename):
+                raise ValueError(f"no stored copy of {self.filename} to patch; send it in full")
+            if file_digest(self.filename) != self.header["base"]:
+                raise ValueError(f"stored copy of {self.filename} is not the version this delta was made against")
+            self.base = open(self.filename, "rb")
+            self.out = open(self.temp_path, "wb")
+        pos = 0
+        while pos < len(self.buffer):
+            op = self.buffer[pos:pos + 1]
+            if op == b"C":
+                if len(self.buffer) - pos < 13:
+                    break
+                offset, length = struct.unpack(">QI", self.buffer[pos + 1:pos + 13])
+                self.base.seek(offset)
+                block = self.base.read(length)
+                if len(block) != length:
+                    raise ValueError("delta refers past the end of the stored copy")
+                self.copied += length
+                pos += 13
+            elif op == b"L":
+                if len(self.buffer) - pos < 5:
+                    break
+                length = struct.unpack(">I", self.buffer[pos + 1:pos + 5])[0]
+                if len(self.buffer) - pos < 5 + length:
+                    break
+                block = bytes(self.buffer[pos + 5:pos + 5 + length])
+                self.literal += length
+                pos += 5 + length
+            else:
+                raise ValueError(f"bad delta op {bytes(op)!r}")
+            self.out.write(block)
+            self.hasher.update(block)
+        del self.buffer[:pos]
+
+    def close(self):
+        """Replace the stored copy with the rebuilt file; ValueError if it does not verify."""
+        if self.base is not None:
+            self.base.close()
+            self.base = None
+        if self.out is not None:
+            self.out.close()
+            self.out = None
+        if self.error is None:
+            if self.header is None or self.buffer:
+                self.error = ValueError("delta ended early")
+            elif self.copied + self.literal != self.header["size"] or self.hasher.hexdigest() != self.header["sha256"]:
+                self.error = ValueError("rebuilt file does not match the sender's SHA-256")
+        if self.error is not None:
+            self.discard()
+            raise ValueError(str(self.error))
+        os.replace(self.temp_path, self.filename)
+
+    def discard(self):
+        for f in (self.base, self.out):
+            if f is not None:
+                f.close()
+        self.base = self.out = None
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+class DeltaWriter(StreamingFileWriter):
+    """StreamingFileWriter for delta transfers: patches the stored copy of `filename`."""
+
+    def open_output(self):
+        return DeltaPatcher(self.filename, self.temp_path)
+
+    def close_output(self):
+        self.out.close()
+        return self.filename
+
+    def discard(self):
+        self.out.discard()
+
+class PartialTransfer:
+    """On-disk state of one framed transfer: fixed-size chunk slots plus a sparse bitmap.
+
+    Chunks may arrive in any order, duplicated, or across several sends of
+    the same file; the contiguous prefix is streamed into the writer as it
+    grows, and the state survives a receiver restart until it completes.
+    """
+
+    META_SIZE = 256
+
+    def __init__(self, header, password=None):
+        self.tid = header["tid"]
+        self.total = header["total"]
+        self.chunk = header["chunk"]
+        self.length = header["length"]
+        self.opts = header["opts"]
+        opts = parse_opts(self.opts)
+        self.codec = opts.get("c", "b64")
+        if self.codec not in PAYLOAD_CODECS:
+            raise ValueError(f"unsupported payload codec {self.codec}")
+        self.compression = opts.get("z", "gzip")
+        Decompressor(self.compression)  # fail on the header, not after the whole transfer
+        self.archive = opts.get("arc") == "1"
+        self.delta = opts.get("dlt") == "1"
+        self.fec = parse_fec(opts.get("fec"))
+        self.slots = self.total + fec_parity_count(self.total, self.fec)
+        self.name = received_name(header["name"])
+        self.duplicates = 0
+        self.recovered = 0
+        base = f".{self.name}.{self.tid:04x}.sonarlink"
+        self.part_path = base + "-part"
+        self.map_path = base + "-map"
+        meta = json.dumps({"tid": self.tid, "total": self.total, "chunk": self.chunk,
+                           "length": self.length, "opts": self.opts}).encode()
+        if self._load(meta):
+            self.part = open(self.part_path, "r+b")
+        else:
+            self.bitmap = bytearray((self.slots + 7) // 8)
+            self.part = open(self.part_path, "w+b")
+            self.part.truncate(self.slots * self.chunk)  # sparse on most filesystems
+            with open(self.map_path, "wb") as f:
+                f.write(meta.ljust(self.META_SIZE, b" ") + self.bitmap)
+        self.map = open(self.map_path, "r+b")
+        self.received = sum(1 for i in range(self.total) if self.has(i))
+        # Password files travel uncompressed, chunk-aligned with their segments
+        self.verifier = SegmentVerifier(self, password) if password and self.compression == "none" else None
+        self.stored = []
+        if self.verifier:
+            self.verifier.check(range(self.total))
+        writer = ArchiveWriter if self.archive else DeltaWriter if self.delta else StreamingFileWriter
+        self.writer = writer(self.name, base + "-out", self.compression)
+        self.fed = 0
+        self._advance()
+
+    def _load(self, meta):
+        if not (os.path.exists(self.map_path) and os.path.exists(self.part_path)):
+            return False
+        with open(self.map_path, "rb") as f:
+            stored = f.read()
+        if stored[:self.META_SIZE].rstrip() != meta:
+            return False
+        self.bitmap = bytearray(stored[self.META_SIZE:])
+        return len(self.bitmap) == (self.slots + 7) // 8
+
+    def has(self, index):
+        return bool(self.bitmap[index >> 3] & (1 << (index & 7)))
+
+    def slot_length(self, index):
+        if index >= self.total:
+            return self.chunk  # parity
+        return min(self.chunk, self.length - index * self.chunk)
+
+    def add(self, index, data):
+        """Store one data or parity chunk; returns False for duplicates and bad sizes."""
+        if index >= self.slots or len(data) != self.slot_length(index):
+            return False
+        if self.has(index):
+            self.duplicates += 1
+            return False
+        self._store(index, data)
+        if self.fec:
+            self._repair(index // self.fec[0] if index < self.total else (index - self.total) // self.fec[1])
+        if self.verifier:
+            self.verifier.check(self.stored)
+        self.stored.clear()
+        self._advance(index, data)
+        return True
 
-try:
-    from cryptography.hazmat.primitives import serialization, hashes, hmac
-    from cryptography.hazmat.primitives.asymmetric import padding
-    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-    from cryptography.hazmat.backends import default_backend
-except ImportError:
-    print("Cryptography not available: install cryptography")
-    HAS_CRYPTO = False
-else:
-    HAS_CRYPTO = True
+    def _store(self, index, data):
+        self.part.seek(index * self.chunk)
+        self.part.write(data)
+        self.part.flush()
+        self.bitmap[index >> 3] |= 1 << (index & 7)
+        self.map.seek(self.META_SIZE + (index >> 3))
+        self.map.write(bytes([self.bitmap[index >> 3]]))
+        self.map.flush()
+        if index < self.total:
+            self.received += 1
+            self.stored.append(index)
 
-SAMPLE_RATE = 48000
-CHUNK_SIZE = 4096
-VOLUME = 80
-PROTOCOL_ID = 1  # GGWAVE_PROTOCOL_AUDIBLE_FAST
-MAX_FILE_SIZE = 10 * 1024 * 1024  # 10 MB limit
-GGWAVE_MAX_BYTES = 120  # Maximum bytes per ggwave transmission
+    def discard(self, index):
+        """Forget a stored data chunk (it failed verification) so it is requested again."""
+        self.bitmap[index >> 3] &= ~(1 << (index & 7))
+        self.map.seek(self.META_SIZE + (index >> 3))
+        self.map.write(bytes([self.bitmap[index >> 3]]))
+        self.map.flush()
+        self.received -= 1
 
-# ------------------
-# Waveform preparation
-# ------------------
-def prepare_waveform(message: str):
-    if not isinstance(message, str):
-        message = message.decode('utf-8', errors='ignore')
-    raw = ggwave.encode(message, protocolId=PROTOCOL_ID, volume=VOLUME)
-    if isinstance(raw, (bytes, bytearray)):
-        return bytes(raw)
-    arr = np.asarray(raw, dtype=np.float32).flatten()
-    return arr.tobytes()
+    def _read(self, index):
+        self.part.seek(index * self.chunk)
+        return self.part.read(self.slot_length(index))
 
-# ------------------
-# Audio transmission
-# ------------------
-def tx_message(waveform):
-    p = pyaudio.PyAudio()
-    try:
-        stream = p.open(format=pyaudio.paFloat32, channels=1,
-                        rate=SAMPLE_RATE, output=True,
-                        frames_per_buffer=CHUNK_SIZE)
-        bytes_per_frame = 4
-        chunk_bytes = CHUNK_SIZE * bytes_per_frame
-        for i in range(0, len(waveform), chunk_bytes):
-            stream.write(waveform[i:i+chunk_bytes])
-            time.sleep(0.05)
-        stream.stop_stream()
-        stream.close()
-    finally:
-        p.terminate()
+    def _repair(self, group):
+        """Rebuild a group's missing data chunks once enough of its chunks arrived."""
+        k, m = self.fec
+        first = group * k
+        count = min(k, self.total - first)
+        present = [i for i in range(first, first + count) if self.has(i)]
+        parity_first = self.total + group * m
+        parity_present = [j for j in range(m) if self.has(parity_first + j)]
+        if len(present) == count or len(present) + len(parity_present) < count:
+            return
+        data = {i - first: self._read(i).ljust(self.chunk, b"\0") for i in present}
+        parity = {j: self._read(parity_first + j) for j in parity_present}
+        for pos, block in fec_recover(count, k, data, parity).items():
+            self._store(first + pos, block[:self.slot_length(first + pos)])
+            self.recovered += 1
+
+    def _advance(self, index=None, data=None):
+        limit = self.verifier.limit() if self.verifier else self.total
+        while self.fed < limit and self.has(self.fed):
+            chunk = data if self.fed == index else self._read(self.fed)
+            self.writer.feed(chunk)
+            self.fed += 1
+
+    def missing(self):
+        return [i for i in range(self.total) if not self.has(i)]
+
+    def complete(self):
+        return self.received == self.total
+
+    def finish(self):
+        """Rename the output into place and drop the on-disk state."""
+        filename = self.writer.finish()
+        self._remove_state()
+        return filename
+
+    def save_corrupted(self):
+        """Keep the reassembled (still compressed) stream as <name>.corrupted."""
+        corrupted_name = self.name + ".corrupted"
+        self.part.close()
+        os.replace(self.part_path, corrupted_name)
+        self.writer.discard()
+        self._remove_state()
+        return corrupted_name
+
+    def close(self):
+        """Keep the state on disk for a later resend; the partial output is rebuilt then."""
+        self.part.close()
+        self.map.close()
+        self.writer.discard()
+
+    def _remove_state(self):
+        self.part.close()
+        self.map.close()
+        for path in (self.part_path, self.map_path):
+            if os.path.exists(path):
+                os.remove(path)
 
 # ------------------
-# AES encryption
+# Receive front end
 # ------------------
-def aes_encrypt(data: bytes, password: str):
-    key = password.encode('utf-8')
-    key = (key * 32)[:32]
-    iv = os.urandom(16)
+# Conditioning between the capture ring and ggwave: resampling from the
+# microphone's native rate, DC removal, a band-pass around the protocol
+# being listened for and automatic gain control, each vectorised over a
+# whole block. Every block is also metered for level and SNR.
+def protocol_band(protocol=None):
+    """Band (Hz) to keep for a protocol; None (or an unmapped id) keeps every protocol's band."""
+    bands = [PROTOCOL_BANDS[protocol]] if protocol in PROTOCOL_BANDS else list(PROTOCOL_BANDS.values())
+    lo = min(band[0] for band in bands) - BANDPASS_MARGIN
+    hi = max(band[1] for band in bands) + BANDPASS_MARGIN
+    return max(lo, 0), min(hi, SAMPLE_RATE // 2)
 
-    # Encrypt the data
-    cipher = Cipher(algorithms.AES(key), modes.CFB(iv), backend=default_backend())
-    encryptor = cipher.encryptor()
-    ciphertext = encryptor.update(data) + encryptor.finalize()
+def lowpass_taps(cutoff, taps, beta=8.0):
+    """Kaiser-windowed sinc low-pass; `cutoff` in cycles per sample."""
+    n = np.arange(taps) - (taps - 1) / 2
+    return 2 * cutoff * np.sinc(2 * cutoff * n) * np.kaiser(taps, beta)
 
-    # Create HMAC for authentication
-    h = hmac.HMAC(key, hashes.SHA256(), backend=default_backend())
-    h.update(iv + ciphertext)
-    mac = h.finalize()
+def dbfs(power):
+    # Floored at -90 dBFS, about the noise of 16-bit capture, so digital silence stays finite
+    return 10 * np.log10(max(power, 1e-9))
 
-    # Return: MAC (32 bytes) + IV (16 bytes) + ciphertext
-    return mac + iv + ciphertext
+class Resampler:
+    """Streaming polyphase resampler from `rate` to SAMPLE_RATE.
 
-def aes_decrypt(data: bytes, password: str):
-    if len(data) < 48:  # MAC(32) + IV(16) minimum
-        raise ValueError("Invalid encrypted data: too short")
+    The windowed-sinc prototype is split into `up` branches; each output
+    sample is one branch dotted with the newest input samples, computed
+    for the whole block in a single gather.
+    """
 
-    key = password.encode('utf-8')
-    key = (key * 32)[:32]
+    def __init__(self, rate, taps=None):
+        taps = taps or RESAMPLE_TAPS
+        common = np.gcd(rate, SAMPLE_RATE)
+        self.up, self.down = SAMPLE_RATE // common, rate // common
+        # Cut just below the lower of the two Nyquist rates
+        cutoff = 0.45 / max(self.up, self.down)
+        prototype = lowpass_taps(cutoff, taps * self.up) * self.up
+        # bank[phase] weighs the taps newest-last, matching the gathered windows
+        self.bank = prototype.reshape(taps, self.up).T[:, ::-1].astype(np.float32)
+        self.offsets = np.arange(1 - taps, 1)
+        self.history = np.zeros(taps - 1, dtype=np.float32)
+        self.position = (taps - 1) * self.up  # next output, in upsampled samples from history[0]
 
-    # Extract components
-    mac = data[:32]
-    iv = data[32:48]
-    ciphertext = data[48:]
+    def process(self, block):
+        buf = np.concatenate([self.history, block])
+        count = max(0, (len(buf) * self.up - 1 - self.position) // self.down + 1)
+        points = self.position + self.down * np.arange(count)
+        windows = buf[(points // self.up)[:, None] + self.offsets]
+        out = np.einsum("ij,ij->i", self.bank[points % self.up], windows)
+        keep = len(self.history)
+        self.position += self.down * count - (len(buf) - keep) * self.up
+        self.history = buf[len(buf) - keep:]
+        return out.astype(np.float32)
 
-    # Verify HMAC
-    h = hmac.HMAC(key, hashes.SHA256(), backend=default_backend())
-    h.update(iv + ciphertext)
-    try:
-        h.verify(mac)
-    except Exception:
-        raise ValueError("Wrong password or corrupted file")
+class FrontEnd:
+    """One lane's conditioning before ggwave: DC removal, band-pass, AGC and a meter.
 
-    # Decrypt
-    cipher = Cipher(algorithms.AES(key), modes.CFB(iv), backend=default_backend())
-    decryptor = cipher.decryptor()
-    return decryptor.update(ciphertext) + decryptor.finalize()
+    `process` returns whole DECODER_FRAME multiples; the rest waits for
+    the next block.
+    """
 
-# ------------------
-# RSA encryption
-# ------------------
-def rsa_encrypt(data: bytes, pubkey_pem: str):
-    pubkey = serialization.load_pem_public_key(pubkey_pem.encode())
-    return pubkey.encrypt(data,
-                          padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                                       algorithm=hashes.SHA256(),
-                                       label=None))
+    def __init__(self, band):
+        self.band = band
+        lo, hi = band[0] / SAMPLE_RATE, band[1] / SAMPLE_RATE
+        self.taps = lowpass_taps(hi, BANDPASS_TAPS, 6.0) - lowpass_taps(lo, BANDPASS_TAPS, 6.0)
+        self.tail = np.zeros(BANDPASS_TAPS - 1)
+        self.spectra = {}  # FFT size -> filter spectrum
+        self.dc = 0.0
+        self.gain = 1.0
+        self.pending = np.zeros(0, dtype=np.float32)
+        self.floor = deque(maxlen=SNR_FLOOR_BLOCKS)
+        self.level_db = None  # last block, dBFS
+        self.snr_db = None  # last block, in-band power over the recent floor
+        self.blocks = 0
+        self.level_sum = 0.0
+        self.snr_peak = None
+        self.clipped = 0
 
-def rsa_decrypt(data: bytes, privkey_path: str, password=None):
-    with open(privkey_path, "rb") as f:
-        privkey = serialization.load_pem_private_key(f.read(), password=password.encode() if password else None)
-    return privkey.decrypt(data,
-                           padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                                        algorithm=hashes.SHA256(),
-                                        label=None))
+    def process(self, block):
+        x = block.astype(np.float64)
+        if len(x) == 0:
+            return self.pending[:0]
+        self.level_db = dbfs(np.mean(x * x))
+        self.blocks += 1
+        self.level_sum += self.level_db
+        if np.max(np.abs(x)) >= CLIP_LEVEL:
+            self.clipped += 1
+        if FRONT_END["dc"]:
+            self.dc += DC_SMOOTHING * (np.mean(x) - self.dc)
+            x -= self.dc
+        if FRONT_END["bandpass"]:
+            x = self._bandpass(x)
+        power = np.mean(x * x)
+        self.floor.append(power)
+        self.snr_db = dbfs(power) - dbfs(min(self.floor))
+        self.snr_peak = self.snr_db if self.snr_peak is None else max(self.snr_peak, self.snr_db)
+        if FRONT_END["agc"]:
+            x = self._agc(x, power)
+        pending = np.concatenate([self.pending, x.astype(np.float32)])
+        ready = len(pending) - len(pending) % DECODER_FRAME
+        self.pending = pending[ready:]
+        return pending[:ready]
 
-# ------------------
-# Send text messages
-# ------------------
-def send_text():
-    print("📝 Enter messages (one per line). Double enter to finish, Ctrl+C to cancel.")
-    messages = []
-    try:
-        while True:
-            msg = input("Message: ").strip()
-            if not msg and messages:
-                break
-            if msg:
-                messages.append(msg)
-    except KeyboardInterrupt:
-        print("\n⏹️ Input cancelled.")
-        return
-    if not messages:
-        print("❌ No messages entered.")
-        return
-    try:
-        for i, msg in enumerate(messages, 1):
-            tx_message(prepare_waveform(msg))
-            print(f"✅ Message {i} sent: {msg[:50]}{'...' if len(msg)>50 else ''}")
-    except KeyboardInterrupt:
-        print("\n⏹️ Transmission interrupted.")
+    def _bandpass(self, x):
+        # Overlap-save: the kept tail makes consecutive blocks one continuous convolution
+        buf = np.concatenate([self.tail, x])
+        size = 1 << (len(buf) - 1).bit_length()
+        spectrum = self.spectra.get(size)
+        if spectrum is None:
+            spectrum = self.spectra[size] = np.fft.rfft(self.taps, size)
+        filtered = np.fft.irfft(np.fft.rfft(buf, size) * spectrum, size)[len(self.tail):len(buf)]
+        self.tail = buf[len(buf) - len(self.tail):]
+        return filtered
+
+    def _agc(self, x, power):
+        wanted = np.clip(AGC_TARGET / np.sqrt(max(power, 1e-12)), 1 / AGC_MAX_GAIN, AGC_MAX_GAIN)
+        rate = AGC_ATTACK if wanted < self.gain else AGC_RELEASE
+        gain = self.gain * (wanted / self.gain) ** rate
+        # Ramp across the block so the gain never steps mid-tone
+        ramp = np.geomspace(self.gain, gain, len(x) + 1)[1:]
+        self.gain = gain
+        return x * ramp
+
+    def stats(self):
+        level = self.level_sum / self.blocks if self.blocks else None
+        return {"band_hz": list(self.band), "blocks": self.blocks, "level_avg_dbfs": level,
+                "snr_peak_db": self.snr_peak, "agc_gain": float(self.gain), "clipped_blocks": self.clipped}
+
+    def summary(self):
+        if not self.blocks:
+            return "no audio"
+        return (f"level avg {self.level_sum / self.blocks:.1f} dBFS, SNR peak {self.snr_peak:.1f} dB, "
+                f"AGC gain {self.gain:.1f}x, clipped blocks {self.clipped}")
 
 # ------------------
-# Send files
+# Audio capture
 # ------------------
-def send_file():
-    print("📁 Send file")
-    print("1. Unencrypted files (multiple files)")
-    print("2. AES encryption (1 file)")
-    print("3. RSA encryption (1 file)")
+def init_decoder(protocol=None):
+    """A ggwave instance listening for one protocol only, or for all of them."""
+    if protocol is None:
+        return ggwave.init()
+    # Receive protocols are a global setting that ggwave.init() copies
+    for protocol_id in PROTOCOL_NAMES:
+        ggwave.rxToggleProtocol(protocol_id, int(protocol_id == protocol))
     try:
-        choice = input("Choice (1-3): ").strip()
-    except KeyboardInterrupt:
-        print("\n⏹️ Operation cancelled.")
-        return
+        return ggwave.init()
+    finally:
+        for protocol_id in PROTOCOL_NAMES:
+            ggwave.rxToggleProtocol(protocol_id, 1)
 
-    if choice == "1":
+class AudioCapture:
+    """Callback-mode microphone capture into a bounded ring, decoded on a worker thread.
+
+    The PortAudio callback only enqueues blocks, so slow decoding or file
+    I/O never stalls the input. When the ring is full the block is dropped
+    and counted instead of overflowing the device silently. `source`
+    defaults to the input of the active TRANSPORT.
+
+    A striped profile gets one ggwave instance per lane, each listening to
+    its own channel and protocol, decoded one after the other (the
+    ggwave binding holds the GIL, so threads would not help).
+    Every lane passes through its own FrontEnd first; channels captured
+    at another rate are resampled once, before the lanes split.
+    """
+
+    def __init__(self, receiver, ring_blocks=None, source=None):
+        self.receiver = receiver
+        self.ring = queue.Queue(maxsize=ring_blocks or CAPTURE_RING_BLOCKS)
+        self.stop_event = threading.Event()
+        self.worker = None
+        self.lanes = capture_lanes()
+        self.channels = profile_channels()
+        self.source = source or make_input(self.channels)
+        self.blocks = 0
+        self.audio_seconds = 0.0
+        receiver.clock = lambda: self.audio_seconds  # transfer timings in audio time, also for replays
+        self.overflows = 0
+        self.dropped_frames = 0
+        self.high_water = 0
+        self.resamplers = []
+        self.front_ends = [FrontEnd(protocol_band(protocol)) for _, protocol in self.lanes]
+        self.meter_time = 0.0
+        self.meter_shown = False
+
+    def start(self):
+        self.source.start(self)
+        self.worker = threading.Thread(target=self._decode_loop, name="sonarlink-decoder", daemon=True)
+        self.worker.start()
+
+    def _on_audio(self, in_data, frame_count, time_info, status):
+        if status & pyaudio.paInputOverflow:
+            self.overflows += 1
         try:
-            files = input("Files separated by comma: ").split(",")
-            files = [f.strip() for f in files if f.strip()]
-        except KeyboardInterrupt:
-            print("\n⏹️ Operation cancelled.")
-            return
-        for fname in files:
-            if not os.path.exists(fname):
-                print(f"❌ File not found: {fname}")
-                continue
-            file_size = os.path.getsize(fname)
-            if file_size > MAX_FILE_SIZE:
-                print(f"❌ File too large: {fname} ({file_size} bytes, max {MAX_FILE_SIZE})")
-                continue
-            with open(fname, "rb") as f:
-                content = f.read()
-            content = gzip.compress(content)
-            encoded = base64.b64encode(content).decode("ascii")
-            tx_message(prepare_waveform(f"FILE:{os.path.basename(fname)}"))
-            time.sleep(3)
-            chunk_count = 0
-            total_chunks = (len(encoded) + GGWAVE_MAX_BYTES - 1) // GGWAVE_MAX_BYTES
-            print(f"   📤 Sending {total_chunks} chunks of max {GGWAVE_MAX_BYTES} chars...")
-            for i in range(0, len(encoded), GGWAVE_MAX_BYTES):
-                tx_message(prepare_waveform(encoded[i:i+GGWAVE_MAX_BYTES]))
-                time.sleep(1.0)
-                chunk_count += 1
-                print(f"   📊 Sent chunk {chunk_count}/{total_chunks}", end="\r")
-            print()
-            time.sleep(2)
-            tx_message(prepare_waveform("ENDFILE"))
-            time.sleep(3)
-            print(f"✅ File sent: {fname}")
+            self.ring.put_nowait((time.perf_counter(), in_data))
+        except queue.Full:
+            self.dropped_frames += frame_count
+        return (None, pyaudio.paContinue)
 
-    elif choice == "2" and HAS_CRYPTO:
+    def _decode_loop(self):
+        if self.source.rate != SAMPLE_RATE:
+            self.resamplers = [Resampler(self.source.rate) for _ in range(self.channels)]
+        instances = [init_decoder(protocol) for _, protocol in self.lanes]
+        reported_drops = 0
         try:
-            fname = input("File to encrypt: ").strip()
-            password = input("AES password: ").strip()
-        except KeyboardInterrupt:
-            print("\n⏹️ Operation cancelled.")
-            return
-        if not os.path.exists(fname):
-            print("❌ File not found")
-            return
-        file_size = os.path.getsize(fname)
-        if file_size > MAX_FILE_SIZE:
-            print(f"❌ File too large ({file_size} bytes, max {MAX_FILE_SIZE})")
+            while not (self.stop_event.is_set() and self.ring.empty()):
+                try:
+                    stamp, data = self.ring.get(timeout=0.25)
+                except queue.Empty:
+                    self.receiver.on_idle()
+                    continue
+                if not self.source.realtime:
+                    stamp = time.perf_counter()  # a replay queues ahead: time the decoding only
+                self.blocks += 1
+                self.audio_seconds += len(data) / (BYTES_PER_FRAME * self.channels * self.source.rate)
+                self.high_water = max(self.high_water, self.ring.qsize() + 1)
+                results = self._decode(instances, data)
+                latency = time.perf_counter() - stamp
+                METRICS.observe("decode_latency_seconds", latency)
+                if results:
+                    self._clear_meter()
+                for res in results:
+                    METRICS.count("frames_received_total")
+                    METRICS.event("frame_rx", bytes=len(res), latency_s=round(latency, 6))
+                    self.receiver.on_frame(res)
+                self.receiver.on_idle()
+                self._show_meter()
+                if self.dropped_frames > reported_drops:
+                    print(f"\n⚠️ Decoder falling behind: {self.dropped_frames} frames dropped so far")
+                    reported_drops = self.dropped_frames
+        finally:
+            for instance in instances:
+                ggwave.free(instance)
+
+    def _decode(self, instances, data):
+        frames = np.frombuffer(data, dtype=np.float32).reshape(-1, self.channels)
+        channels = [frames[:, channel] for channel in range(self.channels)]
+        if self.resamplers:
+            channels = [resampler.process(samples) for resampler, samples in zip(self.resamplers, channels)]
+
+        results = []
+        for (channel, _), front, instance in zip(self.lanes, self.front_ends, instances):
+            block = front.process(channels[channel])
+            res = ggwave.decode(instance, block.tobytes()) if len(block) else None
+            if res:
+                results.append(res)
+        return results
+
+    def _show_meter(self):
+        # Live input only, and only while no transfer owns the progress line
+        # (AckListener, the half-duplex sender's handler, has no transfer)
+        if not (FRONT_END["meter"] and self.source.realtime) or getattr(self.receiver, "transfer", None) is not None:
             return
-        with open(fname, "rb") as f:
-            content = f.read()
-        enc_content = aes_encrypt(content, password)
-        save_name = fname + ".aes"
-        with open(save_name, "wb") as f:
-            f.write(enc_content)
-        print(f"✅ AES file saved: {save_name}")
-        try:
-            send_now = input("Send it now? (y/N): ").strip().lower()
-        except KeyboardInterrupt:
-            print("\n⏹️ Transmission cancelled.")
+        now = time.time()
+        if now - self.meter_time < METER_INTERVAL:
             return
-        if send_now == "y":
-            content = gzip.compress(enc_content)
-            encoded = base64.b64encode(content).decode("ascii")
-            print(f"   🔍 Original file: {len(enc_content)} bytes")
-            print(f"   🔍 After gzip: {len(content)} bytes")
-            print(f"   🔍 After base64: {len(encoded)} characters")
-            total_chunks = (len(encoded) + GGWAVE_MAX_BYTES - 1) // GGWAVE_MAX_BYTES
-            print(f"   📤 Sending {total_chunks} chunks of max {GGWAVE_MAX_BYTES} chars...")
-
-            tx_message(prepare_waveform(f"FILE:{os.path.basename(save_name)}"))
-            print(f"   ✓ Sent filename")
-            time.sleep(3)
-
-            chunk_count = 0
-            for i in range(0, len(encoded), GGWAVE_MAX_BYTES):
-                chunk = encoded[i:i+GGWAVE_MAX_BYTES]
-                print(f"   📊 Preparing chunk {chunk_count+1}/{total_chunks}: {len(chunk)} chars")
-                tx_message(prepare_waveform(chunk))
-                print(f"   ✓ Sent chunk {chunk_count+1}/{total_chunks}")
-                time.sleep(1.0)
-                chunk_count += 1
-
-            print(f"   ✓ All {chunk_count} chunks sent")
-            time.sleep(2)
-            tx_message(prepare_waveform("ENDFILE"))
-            print(f"   ✓ Sent ENDFILE")
-            time.sleep(3)
-            print(f"✅ AES file sent: {save_name}")
+        self.meter_time = now
+        readings = ", ".join(f"{front.level_db:.0f} dBFS / SNR {front.snr_db:.0f} dB"
+                             for front in self.front_ends if front.level_db is not None)
+        print(f"\r   🎚️ Input {readings}   ", end="", flush=True)
+        self.meter_shown = True
 
-    elif choice == "3" and HAS_CRYPTO:
+    def _clear_meter(self):
+        if self.meter_shown:
+            print("\r" + " " * 80 + "\r", end="", flush=True)
+            self.meter_shown = False
+
+    def is_active(self):
+        return self.source.is_active() and self.worker.is_alive()
+
+    def stop(self):
+        self.source.stop()
+        self.stop_event.set()
+        if self.worker is not None:
+            self.worker.join()
+            self.worker = None
+
+    def report(self):
+        self._clear_meter()
+        METRICS.count("input_overflows_total", self.overflows)
+        METRICS.count("dropped_frames_total", self.dropped_frames)
+        METRICS.event("capture", blocks=self.blocks, overflows=self.overflows, dropped_frames=self.dropped_frames,
+                      ring_peak=self.high_water, source_rate=self.source.rate,
+                      lanes=[front.stats() for front in self.front_ends])
+        print(f"   🎙️ Captured {self.blocks} blocks, input overflows: {self.overflows}, "
+              f"dropped frames: {self.dropped_frames} (ring peak {self.high_water}/{self.ring.maxsize})")
+        if self.resamplers:
+            print(f"   🔁 Resampled from {self.source.rate} Hz to {SAMPLE_RATE} Hz")
+        for (channel, _), front in zip(self.lanes, self.front_ends):
+            lane = f"channel {channel + 1}, " if self.channels > 1 else ""
+            band = f"{front.band[0] / 1000:.1f}-{front.band[1] / 1000:.1f} kHz"
+            print(f"   🎚️ {lane}{band}: {front.summary()}")
+
+# ------------------
+# Receive messages/files
+# ------------------
+class Receiver:
+    """Turns decoded ggwave payloads into text messages, files and calibration tallies."""
+
+    def __init__(self, reply=None, password=None):
+        self.reply = reply  # callable sending a text frame back (half-duplex mode)
+        self.password = password  # verifies .aes segments on arrival
+        self.transfer = None
+        self.clock = time.time  # the capture swaps in its audio clock
+        self.started = 0.0
+        self.files_received = 0
+        self.last_message_time = time.time()
+        self.text_messages = []
+        self.chunks_received = 0
+        self.crc_failures = 0
+        self.calibration = {}
+        self.finished = {}  # transfer id -> names saved under it; later copies are ignored
+        self.skipped = set()  # (tid, name) headers already reported as repeats
+        self.strays = set()
+
+    def on_frame(self, res):
         try:
-            fname = input("File to encrypt: ").strip()
-            pubkey_path = input("Public key PEM path: ").strip()
-        except KeyboardInterrupt:
-            print("\n⏹️ Operation cancelled.")
+            text = res.decode("utf-8", errors="ignore")
+            self.last_message_time = time.time()
+
+            if text.startswith("CAL:"):
+                gap = int(text[4:8]) / 1000
+                self.calibration[gap] = self.calibration.get(gap, 0) + 1
+                print(f"   📏 Calibration frame: gap {text[4:8]} ms", end="\r")
+            elif text.startswith("CALEND:"):
+                calibration_report(self.calibration, int(text[7:]))
+                self.calibration = {}
+            elif text.startswith("FILE:"):
+                # Display pending text messages before starting file reception
+                if self.text_messages:
+                    print("\n📨 Text messages received:")
+                    for msg in self.text_messages:
+                        print(f"  → {msg}")
+                    self.text_messages = []
+                header = parse_file_header(text)
+                if header is None:
+                    print(f"❌ Malformed file header: {text[:60]}")
+                elif received_name(header["name"]) in self.finished.get(header["tid"], ()):
+                    self.skip_file(header)
+                else:
+                    self.start_file(header)
+            elif text == "ENDFILE":
+                if self.transfer is not None:
+                    self.end_file()
+            elif text.startswith("WIN:"):
+                self.on_window(text)
+            elif text.startswith("ACK:"):
+                pass  # our own reply picked up by the microphone
+            else:
+                frame = self.parse_chunk(res)
+                if frame is not None:
+                    self.on_chunk(*frame)
+                elif self.transfer is not None:
+                    self.crc_failures += 1
+                    METRICS.count("crc_failures_total")
+                    print(f"\n   ⚠️ Dropped a corrupted chunk (bad frame or CRC mismatch)")
+                else:
+                    # Regular text message
+                    self.text_messages.append(text)
+                    print(f"💬 Message: {text}")
+
+        except Exception as e:
+            print(f"❌ Decoding error: {e}")
+
+    def skip_file(self, header):
+        key = (header["tid"], received_name(header["name"]))
+        if key not in self.skipped:
+            self.skipped.add(key)
+            print(f"\n   ⏭️ Already received {key[1]} (transfer {key[0]:04x}) this session: ignoring the repeat")
+
+    def start_file(self, header):
+        if self.transfer is not None:
+            if self.transfer.tid == header["tid"] and self.transfer.name == received_name(header["name"]):
+                return  # repeated header for the transfer in progress
+            self.transfer.close()
+        self.transfer = PartialTransfer(header, self.password)
+        self.started = self.clock()
+        self.chunks_received = 0
+        print(f"📥 Receiving file: {self.transfer.name} (transfer {self.transfer.tid:04x}, "
+              f"{self.transfer.total} chunks, {self.transfer.length} bytes)")
+        if self.transfer.received:
+            print(f"   ↻ Resuming: {self.transfer.received}/{self.transfer.total} chunks already on disk")
+        else:
+            print(f"   Waiting for data chunks...")
+        if self.transfer.complete():
+            self.end_file()
+
+    def parse_chunk(self, res):
+        # Without a transfer there is no announced codec: the frame is a text message
+        if self.transfer is None:
+            return None
+        return parse_frame(res, self.transfer.codec)
+
+    def on_window(self, text):
+        if self.reply is None:
             return
-        if not os.path.exists(fname) or not os.path.exists(pubkey_path):
-            print("❌ File or key not found")
+        _, tid, lo, hi = text.split(":")
+        tid, lo, hi = int(tid, 16), int(lo), int(hi)
+        if self.transfer is not None and self.transfer.tid == tid:
+            have = [i for i in range(lo, min(hi + 1, self.transfer.total)) if self.transfer.has(i)]
+        elif tid in self.finished:
+            have = range(lo, hi + 1)
+        else:
+            return  # unknown transfer: stay silent so the sender resends its header
+        self.reply(ack_text(tid, lo, have))
+
+    def on_chunk(self, tid, index, total, data):
+        transfer = self.transfer
+        if transfer is None or tid != transfer.tid:
+            if tid not in self.finished and tid not in self.strays:
+                self.strays.add(tid)
+                print(f"\n   ⚠️ Ignoring chunks of unknown transfer {tid:04x} (missed its FILE header?)")
             return
-        file_size = os.path.getsize(fname)
-        if file_size > MAX_FILE_SIZE:
-            print(f"❌ File too large ({file_size} bytes, max {MAX_FILE_SIZE})")
+        if transfer.add(index, data):
+            self.chunks_received += 1
+        print(f"   📦 Chunk {index + 1}/{transfer.slots}: {len(data)} bytes "
+              f"(have {transfer.received}/{transfer.total})", end="\r")
+        if transfer.complete():
+            self.end_file()
+
+    def end_file(self):
+        transfer = self.transfer
+        self.transfer = None
+        print(f"\n   ✓ Chunks received this pass: {self.chunks_received} "
+              f"({transfer.duplicates} duplicate, {self.crc_failures} corrupted)")
+        if transfer.fec:
+            print(f"   🛡️ Rebuilt {transfer.recovered} chunk(s) from FEC parity")
+        if transfer.verifier and transfer.verifier.opened:
+            print(f"   🔐 Segments verified: {len(transfer.verifier.opened)}/{transfer.verifier.count}, "
+                  f"dropped as corrupt: {transfer.verifier.dropped}")
+        counts = {"received": self.chunks_received, "crc_failures": self.crc_failures}
+        self.chunks_received = 0
+        self.crc_failures = 0
+        if not transfer.complete():
+            missing = transfer.missing()
+            self.transfer_done(transfer, "incomplete", missing=len(missing), **counts)
+            transfer.close()
+            print(f"❌ Incomplete file {transfer.name}: missing {len(missing)}/{transfer.total} chunks")
+            print(f"   Missing chunks: {format_ranges(missing)}")
+            print(f"   Progress kept on disk: resend them with Send files → 4 (Resend missing chunks)")
             return
-        with open(fname, "rb") as f:
-            content = f.read()
-        with open(pubkey_path, "r") as kf:
-            pubkey_pem = kf.read()
-        enc_content = rsa_encrypt(content, pubkey_pem)
-        save_name = fname + ".rsa"
-        with open(save_name, "wb") as f:
-            f.write(enc_content)
-        print(f"✅ RSA file saved: {save_name}")
+        self.finished.setdefault(transfer.tid, set()).add(transfer.name)
+        result = "ok"
         try:
-            send_now = input("Send it now? (y/N): ").strip().lower()
-        except KeyboardInterrupt:
-            print("\n⏹️ Transmission cancelled.")
-            return
-        if send_now == "y":
-            content = gzip.compress(enc_content)
-            encoded = base64.b64encode(content).decode("ascii")
-            tx_message(prepare_waveform(f"FILE:{os.path.basename(save_name)}"))
-            time.sleep(3)
-            chunk_count = 0
-            total_chunks = (len(encoded) + GGWAVE_MAX_BYTES - 1) // GGWAVE_MAX_BYTES
-            print(f"   📤 Sending {total_chunks} chunks of max {GGWAVE_MAX_BYTES} chars...")
-            for i in range(0, len(encoded), GGWAVE_MAX_BYTES):
-                tx_message(prepare_waveform(encoded[i:i+GGWAVE_MAX_BYTES]))
-                time.sleep(1.0)
-                chunk_count += 1
-                print(f"   📊 Sent chunk {chunk_count}/{total_chunks}", end="\r")
-            print()
-            time.sleep(2)
-            tx_message(prepare_waveform("ENDFILE"))
-            time.sleep(3)
-            print(f"✅ RSA file sent: {save_name}")
+            output_filename = transfer.finish()
+            print(f"   ✓ Compressed stream: {transfer.writer.compressed} bytes ({transfer.compression})")
+            print(f"   ✓ Decompressed: {transfer.writer.written} bytes")
+            if transfer.archive:
+                print(f"✅ Archive unpacked: {len(transfer.writer.out.unpacked)} files into {output_filename}/")
+            elif transfer.delta:
+                patcher = transfer.writer.out
+                print(f"   Δ Rebuilt from the stored copy: {patcher.copied} bytes reused, {patcher.literal} new")
+                print(f"✅ File updated and verified: {output_filename}")
+            else:
+                print(f"✅ File received and saved: {output_filename}")
+        except ValueError as e:
+            result = "corrupt"
+            print(f"❌ File corrupted during transmission ({e})")
+            # Save the corrupted file for debugging
+            corrupted_name = transfer.save_corrupted()
+            print(f"   Saved corrupted data to: {corrupted_name}")
+        except Exception as e:
+            result = "error"
+            transfer.close()
+            print(f"❌ Error saving file: {e}")
+        finally:
+            self.files_received += 1
+            self.transfer_done(transfer, result, missing=0, **counts)
 
-    else:
-        print("❌ Invalid option or cryptography not available")
-
-# ------------------
-# Receive messages/files
-# ------------------
-def receive():
-    p = pyaudio.PyAudio()
-    try:
-        stream = p.open(format=pyaudio.paFloat32, channels=1,
-                        rate=SAMPLE_RATE, input=True,
-                        frames_per_buffer=CHUNK_SIZE)
-    except Exception as e:
-        print("Error opening microphone:", e)
-        return
+    def transfer_done(self, transfer, result, received, crc_failures, missing):
+        seconds = self.clock() - self.started
+        goodput = transfer.length / seconds if result == "ok" and seconds > 0 else 0.0
+        METRICS.count("transfers_total", direction="rx", result=result)
+        METRICS.count("chunks_missing_total", missing)
+        METRICS.gauge("goodput_bytes_per_second", goodput, direction="rx")
+        METRICS.event("transfer_rx", tid=f"{transfer.tid:04x}", name=transfer.name, result=result,
+                      bytes=transfer.length, chunks=transfer.total, received=received,
+                      missing=missing, duplicates=transfer.duplicates, crc_failures=crc_failures,
+                      recovered=transfer.recovered, seconds=round(seconds, 3), goodput_bps=round(goodput, 2))
+        METRICS.flush()
 
-    instance = ggwave.init()
-    print(f"🎧 Listening at {SAMPLE_RATE} Hz... Ctrl+C to stop.")
+    def on_idle(self):
+        # Display accumulated text messages after 3 seconds of silence
+        if self.text_messages and (time.time() - self.last_message_time > 3):
+            print(f"\n✅ Received {len(self.text_messages)} text message(s)")
+            self.text_messages = []
 
-    buffer = ""
-    filename = None
-    is_file = False
-    files_received = 0
-    last_message_time = time.time()
-    text_messages = []
-    chunks_received = 0
+    def close(self):
+        if self.text_messages:
+            print(f"\n📨 Final text messages received:")
+            for msg in self.text_messages:
+                print(f"  → {msg}")
+            self.text_messages = []
+        if self.transfer is not None:
+            print(f"   💾 Partial transfer {self.transfer.tid:04x} kept on disk "
+                  f"({self.transfer.received}/{self.transfer.total} chunks)")
+            self.transfer.close()
+            self.transfer = None
 
+def receive(duplex=None, password=None):
+    interactive = duplex is None
+    if TRANSPORT["kind"] != "audio":
+        duplex = False  # nobody to answer on a recording
     try:
-        while True:
-            try:
-                data = stream.read(CHUNK_SIZE, exception_on_overflow=False)
-            except IOError:
-                continue
-
-            res = ggwave.decode(instance, data)
-            if res:
-                try:
-                    text = res.decode("utf-8", errors="ignore")
-                    last_message_time = time.time()
-
-                    if text.startswith("FILE:"):
-                        # Display pending text messages before starting file reception
-                        if text_messages:
-                            print("\n📨 Text messages received:")
-                            for msg in text_messages:
-                                print(f"  → {msg}")
-                            text_messages = []
-
-                        filename = text[5:].strip()
-                        buffer = ""
-                        is_file = True
-                        chunks_received = 0
-                        print(f"📥 Receiving file: {filename}")
-                        print(f"   Waiting for data chunks...")
-                    elif text == "ENDFILE" and is_file:
-                        print(f"\n   ✓ Received ENDFILE signal")
-                        print(f"   ✓ Total chunks received: {chunks_received}")
-                        print(f"   ✓ Total characters: {len(buffer)}")
-                        try:
-                            content = base64.b64decode(buffer)
-                            print(f"   ✓ Base64 decoded: {len(content)} bytes")
-                            content = gzip.decompress(content)
-                            print(f"   ✓ Decompressed: {len(content)} bytes")
-                            output_filename = filename
-                            with open(output_filename, "wb") as f:
-                                f.write(content)
-                            print(f"✅ File received and saved: {output_filename}")
-                        except gzip.BadGzipFile:
-                            print(f"❌ File corrupted during transmission (bad gzip)")
-                            print(f"   Expected more data chunks")
-                            # Save the corrupted file for debugging
-                            corrupted_name = filename + ".corrupted"
-                            with open(corrupted_name, "wb") as f:
-                                f.write(base64.b64decode(buffer))
-                            print(f"   Saved corrupted data to: {corrupted_name}")
-                        except Exception as e:
-                            print(f"❌ Error saving file: {e}")
-                        finally:
-                            buffer = ""
-                            filename = None
-                            is_file = False
-                            files_received += 1
-                            chunks_received = 0
-                    elif is_file:
-                        # Part of file transmission
-                        buffer += text
-                        chunks_received += 1
-                        # Show progress every chunk
-                        print(f"   📦 Chunk {chunks_received}: {len(text)} chars (total: {len(buffer)})", end="\r")
-                    else:
-                        # Regular text message
-                        text_messages.append(text)
-                        print(f"💬 Message: {text}")
+        if duplex is None:
+            duplex = input("Reply with ACK/NACK to half-duplex senders? (y/N): ").strip().lower() == "y"
+        if interactive and HAS_CRYPTO:
+            password = input("AES password to verify .aes files as they arrive (Enter to skip): ").strip()
+    except KeyboardInterrupt:
+        print("\n⏹️ Operation cancelled.")
+        return
+    session = TxSession() if duplex else None
+    replier = ThreadPoolExecutor(max_workers=1) if duplex else None
 
-                except Exception as e:
-                    print(f"❌ Decoding error: {e}")
+    def reply(text):
+        # Played off the decoder thread so capture keeps draining meanwhile
+        def send():
+            time.sleep(PACING["settle"])  # let the sender's last frame ring out
+            tx_message(prepare_waveform(text), session)
+        replier.submit(send)
 
-            # Display accumulated text messages after 3 seconds of silence
-            if text_messages and (time.time() - last_message_time > 3):
-                print(f"\n✅ Received {len(text_messages)} text message(s)")
-                text_messages = []
+    receiver = Receiver(reply if duplex else None, password or None)
+    capture = AudioCapture(receiver)
+    try:
+        if session is not None:
+            session.open()
+        capture.start()
+    except Exception as e:
+        print("Error opening audio device:", e)
+        if session is not None:
+            session.close()
+        return
 
+    if TRANSPORT["kind"] == "audio":
+        print(f"🎧 Listening at {capture.source.rate} Hz{' (half-duplex)' if duplex else ''}... Ctrl+C to stop.")
+    else:
+        print(f"🎧 Decoding {TRANSPORT['path'] if TRANSPORT['kind'] == 'wav' else 'loopback buffer'}...")
+    try:
+        while capture.is_active():
+            time.sleep(0.1)
     except KeyboardInterrupt:
         print("\n⏹️ Reception interrupted by user.")
-        if text_messages:
-            print(f"\n📨 Final text messages received:")
-            for msg in text_messages:
-                print(f"  → {msg}")
     finally:
-        stream.stop_stream()
-        stream.close()
-        p.terminate()
-        ggwave.free(instance)
+        capture.stop()
+        receiver.close()
+        if session is not None:
+            replier.shutdown(wait=True)
+            session.close()
+        capture.report()
+        METRICS.flush()
         print("✅ Cleanup completed.")
 
 # ------------------
 # Decrypt files
 # ------------------
+def save_unpacked(packed, output_name):
+    """Decompress a decrypted spool into output_name; nothing is left behind on failure."""
+    packed.seek(0)
+    try:
+        with open(output_name, "wb") as out:
+            unpack_compressed_file(packed, out)
+    except Exception:
+        os.remove(output_name)
+        raise
+
+def report_corrupt_segments(error):
+    print(f"❌ Decryption failed: {error}")
+    if error.chunks:
+        print(f"   Affected chunks: {format_ranges(error.chunks)}")
+    print("   The other segments authenticated fine: receive the file again and retry")
+
 def decrypt_file():
     print("🔐 Decrypt file (.aes / .rsa)")
     try:
@@ -442,19 +4000,20 @@ def decrypt_file():
             while True:
                 try:
                     password = input("AES password: ").strip()
-                    with open(fname, "rb") as f:
-                        encrypted_content = f.read()
-
-                    # Try to decrypt - this will raise an exception if it fails
-                    decrypted_content = aes_decrypt(encrypted_content, password)
-
-                    # Only save if decryption succeeded
                     output_name = fname.replace(".aes", "_dec.bin")
-                    with open(output_name, "wb") as f:
-                        f.write(decrypted_content)
+                    with open(fname, "rb") as f, tempfile.TemporaryFile() as packed:
+                        # Try to decrypt - this will raise an exception if it fails
+                        aes_decrypt_file(f, packed, password)
+
+                        # Only save if decryption succeeded
+                        save_unpacked(packed, output_name)
                     print(f"✅ AES file decrypted and saved: {output_name}")
                     break
 
+                except CorruptSegments as e:
+                    report_corrupt_segments(e)
+                    return
+
                 except (ValueError, Exception) as e:
                     print(f"❌ Decryption failed: Wrong password or corrupted file")
                     retry = input("Retry with different password? (y/N): ").strip().lower()
@@ -475,19 +4034,20 @@ def decrypt_file():
                         continue
 
                     password = input("Private key password (empty if none): ").strip() or None
-                    with open(fname, "rb") as f:
-                        encrypted_content = f.read()
-
-                    # Try to decrypt - this will raise an exception if it fails
-                    decrypted_content = rsa_decrypt(encrypted_content, privkey_path, password)
-
-                    # Only save if decryption succeeded
                     output_name = fname.replace(".rsa", "_dec.bin")
-                    with open(output_name, "wb") as f:
-                        f.write(decrypted_content)
+                    with open(fname, "rb") as f, tempfile.TemporaryFile() as packed:
+                        # Try to decrypt - this will raise an exception if it fails
+                        rsa_decrypt_file(f, packed, privkey_path, password)
+
+                        # Only save if decryption succeeded
+                        save_unpacked(packed, output_name)
                     print(f"✅ RSA file decrypted and saved: {output_name}")
                     break
 
+                except CorruptSegments as e:
+                    report_corrupt_segments(e)
+                    return
+
                 except Exception as e:
                     print(f"❌ Decryption failed: Wrong key, wrong password, or corrupted file")
                     print(f"   Error details: {str(e)}")
@@ -508,14 +4068,17 @@ def decrypt_file():
 # ------------------
 def main():
     while True:
-        print("\n=== SonarLink v1.0 ===")
+        transport = "" if TRANSPORT["kind"] == "audio" else f", {TRANSPORT['kind']}"
+        print(f"\n=== SonarLink v1.0 ({ACTIVE_PROFILE}{transport}) ===")
         print("1. Send text messages")
         print("2. Send files")
         print("3. Receive messages or files")
         print("4. Decrypt received file")
-        print("5. Exit")
+        print("5. Calibrate pacing")
+        print("6. Transmission profile / benchmark")
+        print("7. Exit")
         try:
-            choice = input("Choice (1-5): ").strip()
+            choice = input("Choice (1-7): ").strip()
         except KeyboardInterrupt:
             print("\n⏹️ Exiting menu.")
             break
@@ -528,10 +4091,93 @@ def main():
         elif choice == "4":
             decrypt_file()
         elif choice == "5":
+            calibrate_pacing()
+        elif choice == "6":
+            choose_profile()
+        elif choice == "7":
             print("👋 Goodbye.")
             break
         else:
             print("❌ Invalid option.")
 
+# ------------------
+# Command line
+# ------------------
+def cli(argv=None):
+    """Non-interactive entry point; without a command it opens the menu."""
+    parser = argparse.ArgumentParser(
+        prog="sonarlink", description="Send and receive messages and files via ggwave. "
+                                      "Without a command, opens the interactive menu.")
+    parser.add_argument("--tx-profile", choices=list(PROFILES), default=ACTIVE_PROFILE, metavar="NAME",
+                        help=f"transmission profile: {', '.join(PROFILES)} (default: %(default)s)")
+    parser.add_argument("--transport", choices=("audio", "wav"), default=TRANSPORT["kind"],
+                        help="speaker/microphone, or a WAV file (default: %(default)s)")
+    parser.add_argument("--wav", metavar="PATH", help=f"WAV file for --transport wav (default: {TRANSPORT['path']})")
+    parser.add_argument("--waveform-cache", metavar="DIR", help="also keep rendered waveforms on disk in DIR")
+    parser.add_argument("--telemetry", metavar="PATH", help="append per-frame and per-transfer events as JSON lines")
+    parser.add_argument("--prometheus", metavar="PATH",
+                        help="keep counters and timings in a Prometheus textfile (node_exporter collector)")
+    parser.add_argument("--station", metavar="NAME", help=f"station label on every metric (default: {TELEMETRY['station']})")
+    parser.add_argument("--profile", action="store_true",
+                        help="time the hot paths (encode, playback, decode, reassembly) and print a table at exit")
+    commands = parser.add_subparsers(dest="command")
+    send = commands.add_parser("send", help="send files; directories (or --batch) go as one archive")
+    send.add_argument("paths", nargs="+", metavar="PATH")
+    send.add_argument("--batch", action="store_true", help="pack every path into one compressed archive stream")
+    send.add_argument("--delta", metavar="RECEIVER",
+                      help="send only what changed since the last send to RECEIVER (files only)")
+    send.add_argument("--only", metavar="RANGES", help="resend only these chunks, e.g. 3,17-19")
+    send.add_argument("--carousel", action="store_true", help="loop the transfer until Ctrl+C for late joiners")
+    send.add_argument("--cycles", type=int, metavar="N", help="stop the carousel after N cycles")
+    text = commands.add_parser("text", help="send text messages, one per argument")
+    text.add_argument("messages", nargs="+", metavar="MESSAGE")
+    listen = commands.add_parser("receive", help="receive until Ctrl+C (or the end of the WAV file)")
+    listen.add_argument("--duplex", action="store_true", help="answer half-duplex senders with ACK/NACK")
+    listen.add_argument("--verify-aes", action="store_true",
+                        help="ask for the AES password and verify .aes files segment by segment as they arrive")
+    args = parser.parse_args(argv)
+
+    set_profile(args.tx_profile)
+    set_transport(args.transport, args.wav)
+    if args.waveform_cache:
+        WAVEFORMS.use_disk(args.waveform_cache)
+    TELEMETRY.update(jsonl=args.telemetry, prometheus=args.prometheus, station=args.station or TELEMETRY["station"])
+    if args.profile:
+        enable_profiling()
+    try:
+        return run_command(parser, args)
+    finally:
+        if args.profile:
+            profile_report()
+        METRICS.close()
+
+def run_command(parser, args):
+    if args.command is None:
+        main()
+    elif args.command == "send":
+        try:
+            only = parse_ranges(args.only) if args.only else None
+        except ValueError:
+            parser.error(f"invalid chunk ranges: {args.only}")
+        if args.carousel:
+            return 0 if send_carousel(args.paths, args.cycles) else 1
+        if args.delta:
+            if args.batch or any(os.path.isdir(path) for path in args.paths):
+                parser.error("--delta sends files, not batch archives")
+            return 0 if send_delta(args.paths, args.delta, only) == len(args.paths) else 1
+        if args.batch or any(os.path.isdir(path) for path in args.paths):
+            return 0 if send_batch(args.paths, only) else 1
+        return 0 if send_files(args.paths, only) == len(args.paths) else 1
+    elif args.command == "text":
+        send_messages(args.messages)
+    elif args.command == "receive":
+        password = None
+        if args.verify_aes:
+            if not HAS_CRYPTO:
+                parser.error("--verify-aes needs the cryptography package")
+            password = input("AES password: ").strip()
+        receive(duplex=args.duplex, password=password)
+    return 0
+
 if __name__ == "__main__":
-    main()
+    sys.exit(cli())
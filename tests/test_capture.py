@@ -0,0 +1,56 @@
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sonarlink
+
+
+class LiveInput:
+    """Realtime input that plays prepared blocks into the capture ring, like a microphone."""
+
+    realtime = True
+    rate = sonarlink.SAMPLE_RATE
+
+    def __init__(self, blocks):
+        self.blocks = blocks
+        self.thread = None
+
+    def start(self, capture):
+        def feed():
+            for block in self.blocks:
+                capture.ring.put((time.perf_counter(), block))
+        self.thread = threading.Thread(target=feed, daemon=True)
+        self.thread.start()
+
+    def is_active(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def stop(self):
+        if self.thread is not None:
+            self.thread.join()
+
+
+def test_ack_listener_survives_live_meter(monkeypatch):
+    monkeypatch.setitem(sonarlink.FRONT_END, "meter", True)
+    monkeypatch.setattr(sonarlink, "METER_INTERVAL", 0.0)
+    sonarlink.set_profile("default")
+    ack = sonarlink.ack_text(0x1234, 0, range(4))
+    silence = np.zeros(sonarlink.SAMPLE_RATE // 2, dtype=np.float32)
+    samples = np.concatenate([silence, np.frombuffer(sonarlink.prepare_waveform(ack), dtype=np.float32), silence])
+    blocks = [samples[i:i + sonarlink.CHUNK_SIZE].tobytes() for i in range(0, len(samples), sonarlink.CHUNK_SIZE)]
+
+    listener = sonarlink.AckListener()
+    listener.tid = 0x1234
+    capture = sonarlink.AudioCapture(listener, source=LiveInput(blocks))
+    capture.start()
+    try:
+        assert listener.acks.get(timeout=30) == ack
+        assert capture.worker.is_alive()
+    finally:
+        capture.stop()
+    assert capture.blocks > 0